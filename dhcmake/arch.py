@@ -3,22 +3,102 @@
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
 
+import json
+import os.path
+import re
+import shutil
 import subprocess
 
+from dhcmake import fileutil, timing
+
+
+def get_dpkg_datadir():
+    return os.environ.get("DPKG_DATADIR", "/usr/share/dpkg")
+
+
+_debarch_tuples = None
+
+
+def _load_table(name):
+    with open(os.path.join(get_dpkg_datadir(), name), "r") as f:
+        for line in f:
+            if not re.search("^(\\s*$|#)", line):
+                yield line.split()
+
+
+# Mirror of Dpkg::Arch, so that matching architecture wildcards does not need
+# a dpkg-architecture process for every (arch, wildcard) pair
+def load_debarch_tuples():
+    global _debarch_tuples
+    if _debarch_tuples is None:
+        debarch_tuples = dict()
+        debtuples = set()
+        try:
+            cpus = [fields[0] for fields in _load_table("cputable")]
+            for debtuple, debarch in _load_table("tupletable"):
+                if "<cpu>" in debtuple:
+                    expanded = [(debtuple.replace("<cpu>", cpu),
+                                 debarch.replace("<cpu>", cpu))
+                                for cpu in cpus]
+                else:
+                    expanded = [(debtuple, debarch)]
+                for t, a in expanded:
+                    if a not in debarch_tuples and t not in debtuples:
+                        debarch_tuples[a] = tuple(t.split("-", 3))
+                        debtuples.add(t)
+        except FileNotFoundError:
+            debarch_tuples = dict()
+        _debarch_tuples = debarch_tuples
+
+    return _debarch_tuples
+
+
+def debarch_to_debtuple(arch):
+    match = re.search("^linux-([^-]*)", arch)
+    if match:
+        arch = match.group(1)
+    return load_debarch_tuples().get(arch)
+
+
+def debwildcard_to_debtuple(alias):
+    debtuple = alias.split("-", 3)
+    if "any" in debtuple:
+        return ("any",) * (4 - len(debtuple)) + tuple(debtuple)
+    else:
+        return debarch_to_debtuple(alias)
+
+
+def _debarch_is_dpkg_architecture(real, alias):
+    args = ["dpkg-architecture", "-i", alias, "-a", real, "-f"]
+    with timing.phase("cmd", " ".join(args)):
+        return subprocess.run(
+            args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        ).returncode == 0
+
+
+def _debarch_is_tuple(real, alias):
+    if alias == real or alias == "any":
+        return True
+
+    real_tuple = debarch_to_debtuple(real)
+    alias_tuple = debwildcard_to_debtuple(alias)
+    if real_tuple is None or alias_tuple is None:
+        # Unknown to the tables we loaded, ask dpkg-architecture itself
+        return _debarch_is_dpkg_architecture(real, alias)
+
+    return all(a in (r, "any") for r, a in zip(real_tuple, alias_tuple))
+
 
 _known_archs = dict()
 
 
 def debarch_is(real, alias):
-    global _known_archs
     try:
         result = _known_archs[(real, alias)]
     except KeyError:
-        result = subprocess.run(
-            ["dpkg-architecture", "-i", alias, "-a", real, "-f"],
-            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        ).returncode == 0
+        result = _debarch_is_tuple(real, alias)
         _known_archs[(real, alias)] = result
+        _set_cache_dirty()
     return result
 
 
@@ -36,11 +116,75 @@ def dpkg_architecture():
     global _dpkg_architecture_values
     if _dpkg_architecture_values is None:
         _dpkg_architecture_values = dict()
-        proc = subprocess.run(["dpkg-architecture"], stdout=subprocess.PIPE)
+        with timing.phase("cmd", "dpkg-architecture"):
+            proc = subprocess.run(["dpkg-architecture"],
+                                  stdout=subprocess.PIPE)
         output = proc.stdout.decode()
         for line in output.split("\n"):
             if line:
                 key, value = line.split("=", maxsplit=1)
                 _dpkg_architecture_values[key] = value
+        _set_cache_dirty()
 
     return _dpkg_architecture_values
+
+
+_cache_dirty = False
+
+
+def _set_cache_dirty():
+    global _cache_dirty
+    _cache_dirty = True
+
+
+def get_cache_key():
+    # dpkg-architecture only depends on these variables and on the installed
+    # dpkg, which is identified by the files it ships
+    env = {k: v for k, v in os.environ.items()
+           if re.search("^(DEB_(BUILD|HOST|TARGET)_|DPKG_)", k)}
+    files = []
+    for path in [shutil.which("dpkg-architecture")] + [
+            os.path.join(get_dpkg_datadir(), t)
+            for t in ("cputable", "ostable", "tupletable")]:
+        try:
+            st = os.stat(path)
+            files.append([path, st.st_mtime_ns, st.st_size])
+        except (OSError, TypeError):
+            files.append([path, None, None])
+    return {"env": env, "files": files}
+
+
+def load_cache(path):
+    global _dpkg_architecture_values, _cache_dirty
+    try:
+        with open(path, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not isinstance(cache, dict) or cache.get("key") != get_cache_key():
+        return False
+
+    if _dpkg_architecture_values is None and \
+            cache.get("dpkg_architecture") is not None:
+        _dpkg_architecture_values = dict(cache["dpkg_architecture"])
+    for real, alias, result in cache.get("debarch_is", []):
+        _known_archs.setdefault((real, alias), result)
+    _cache_dirty = False
+    return True
+
+
+def save_cache(path):
+    global _cache_dirty
+    if not _cache_dirty and os.path.exists(path):
+        return
+
+    cache = {
+        "key": get_cache_key(),
+        "dpkg_architecture": _dpkg_architecture_values,
+        "debarch_is": sorted([real, alias, result] for (real, alias), result
+                             in _known_archs.items()),
+    }
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with fileutil.atomic_write(path) as f:
+        json.dump(cache, f)
+    _cache_dirty = False
@@ -2,11 +2,30 @@
 # BSD 3-Clause license. See top-level LICENSE file or
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
+import hashlib
+import json
+import os
 import re
-from dhcmake import common
+import urllib.parse
+from dhcmake import common, fileutil, timing
+
+
+INSTALL_STATE_DIR = "debian/.debhelper/dh-cmake-install"
+
+
+def _stat_fingerprint(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
 
 
 class DHCMake(common.DHCommon):
+    def __init__(self):
+        super().__init__()
+        self._install_script_fingerprints = {}
+
     def get_cmake_components(self, package):
         opened_file = self.read_package_file(package, "cmake-components")
         if opened_file:
@@ -15,6 +34,96 @@ class DHCMake(common.DHCommon):
         else:
             return []
 
+    def get_install_state(self, package, component):
+        return os.path.join(INSTALL_STATE_DIR, package,
+                            urllib.parse.quote(component, safe=""))
+
+    def get_kept_install_manifest(self, builddir, package, component=None):
+        if getattr(self.options, "incremental", False) and component:
+            return self.get_install_state(package, component) + ".manifest"
+        return None
+
+    def get_install_script_fingerprint(self, script):
+        # Fingerprint the install scripts and everything they install from
+        # the source and build trees, i.e. every file that a rebuild could
+        # have changed
+        try:
+            return self._install_script_fingerprints[script]
+        except KeyError:
+            pass
+
+        roots = tuple(os.path.join(os.path.abspath(p), "")
+                      for p in (".", os.path.dirname(script)))
+        h = hashlib.sha256()
+        scripts = [script]
+        seen = set(scripts)
+        while scripts:
+            path = scripts.pop()
+            h.update(json.dumps([path, _stat_fingerprint(path)]).encode())
+            try:
+                with open(path, "r") as f:
+                    contents = f.read()
+            except FileNotFoundError:
+                continue
+
+            for p in re.findall("\"(/[^\"$]*)\"", contents):
+                if p in seen or not p.startswith(roots):
+                    continue
+                seen.add(p)
+                if p.endswith("/cmake_install.cmake"):
+                    scripts.append(p)
+                elif os.path.isdir(p):
+                    for dirpath, dirnames, filenames in sorted(os.walk(p)):
+                        for name in sorted(filenames):
+                            name = os.path.join(dirpath, name)
+                            h.update(json.dumps(
+                                [name, _stat_fingerprint(name)]).encode())
+                else:
+                    h.update(json.dumps([p, _stat_fingerprint(p)]).encode())
+
+        fingerprint = h.hexdigest()
+        self._install_script_fingerprints[script] = fingerprint
+        return fingerprint
+
+    def get_install_fingerprint(self, builddir, package, component,
+                                install_manifest):
+        args, env = self.get_cmake_install_cmd(builddir, package, component)
+        destdir = env["DESTDIR"]
+
+        h = hashlib.sha256()
+        with open(install_manifest, "r") as f:
+            for l in f:
+                path = destdir + l.rstrip("\n")
+                h.update(json.dumps([path, _stat_fingerprint(path)]).encode())
+
+        return {
+            "args": args,
+            "destdir": destdir,
+            "script": self.get_install_script_fingerprint(os.path.join(
+                os.path.abspath(builddir), "cmake_install.cmake")),
+            "installed": h.hexdigest(),
+        }
+
+    def install_is_current(self, builddir, package, component):
+        state = self.get_install_state(package, component)
+        try:
+            with open(state + ".json", "r") as f:
+                fingerprint = json.load(f)
+            return fingerprint == self.get_install_fingerprint(
+                builddir, package, component, state + ".manifest")
+        except (OSError, ValueError):
+            return False
+
+    def save_install_fingerprint(self, builddir, package, component):
+        state = self.get_install_state(package, component)
+        try:
+            fingerprint = self.get_install_fingerprint(
+                builddir, package, component, state + ".manifest")
+        except FileNotFoundError:
+            return
+        with fileutil.atomic_write(state + ".json") as f:
+            json.dump(fingerprint, f)
+
     def install_make_arg_parser(self, parser):
         self.make_arg_parser(parser)
         parser.add_argument(
@@ -25,24 +134,54 @@ class DHCMake(common.DHCommon):
             help="Source directory for installation (not used except to notify"
                  " dh_missing)",
             default="debian/tmp")
+        parser.add_argument(
+            "--incremental", action="store_true",
+            help="Skip components whose build and installed files have not"
+                 " changed since the last run")
 
     @common.DHEntryPoint("dh_cmake_install")
     def install(self, args=None):
         self.parse_args(args, make_arg_parser=self.install_make_arg_parser)
+        builddir = self.get_build_directory()
         if self.options.component:
             packages = self.get_packages()
             if len(packages) != 1:
                 raise common.PackageError("Can only specify one package when "
                                           "specifying components")
             p = packages[0]
-            for c in self.options.component:
-                self.do_cmake_install(self.get_build_directory(), p,
-                                      component=c)
+            installs = [dict(builddir=builddir, package=p, component=c)
+                        for c in self.options.component]
         else:
-            for p in self.get_packages():
-                for c in self.get_cmake_components(p):
-                    self.do_cmake_install(self.get_build_directory(), p,
-                                          component=c)
+            installs = [dict(builddir=builddir, package=p, component=c)
+                        for p in self.get_packages()
+                        for c in self.get_cmake_components(p)]
+
+        if self.options.incremental and not self.options.no_act:
+            remaining = []
+            for install in installs:
+                with timing.phase("phase", "install_is_current",
+                                  package=install["package"],
+                                  component=install["component"]):
+                    current = self.install_is_current(**install)
+                if current:
+                    if self.options.verbose:
+                        print("\t# Component %s of %s is up to date" %
+                              (install["component"], install["package"]),
+                              file=self.stdout)
+                    state = self.get_install_state(install["package"],
+                                                   install["component"])
+                    with open(state + ".manifest", "r") as f:
+                        self.log_installed_files(
+                            install["package"], self.iter_install_manifest(f))
+                else:
+                    remaining.append(install)
+            installs = remaining
+
+        self.do_cmake_installs(installs)
+
+        if self.options.incremental and not self.options.no_act:
+            for install in installs:
+                self.save_install_fingerprint(**install)
 
 
 def install():
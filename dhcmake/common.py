@@ -3,18 +3,23 @@
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
 import argparse
+import hashlib
 import io
+import json
 import os.path
+import re
 import subprocess
 import sys
 
-from dhcmake import deb822, arch
-import debian.deb822
+from dhcmake import arch, fileutil, timing
 
 
 MIN_COMPAT = 1
 MAX_COMPAT = 1
 
+ARCH_CACHE = "debian/.debhelper/dh-cmake-arch-cache.json"
+PACKAGE_FILE_CACHE = "debian/.debhelper/dh-cmake-package-files"
+
 
 class CompatError(Exception):
     pass
@@ -42,12 +47,96 @@ def escape_substvar(value):
     return value
 
 
+def get_deb_build_parallel():
+    try:
+        deb_build_options = os.environ["DEB_BUILD_OPTIONS"]
+    except KeyError:
+        return None
+
+    for option in re.split("[\\s,]+", deb_build_options):
+        key, sep, value = option.partition("=")
+        if key == "parallel" and sep:
+            try:
+                return max(int(value), 1)
+            except ValueError:
+                pass
+
+    return None
+
+
+_package_file_outputs = dict()
+
+
+def get_package_file_env():
+    return sorted((k, v) for k, v in os.environ.items()
+                  if re.search("^(DEB_|DPKG_|DH_(?!INTERNAL_))", k))
+
+
+def run_package_file(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = json.dumps([path, st.st_mtime_ns, st.st_size,
+                      get_package_file_env()])
+    try:
+        return _package_file_outputs[key]
+    except KeyError:
+        pass
+
+    # The on-disk cache is shared by all dh_* commands of one build, and is
+    # removed by dh_clean along with the rest of debian/.debhelper
+    cache_file = None
+    output = None
+    if os.environ.get("DH_CMAKE_PACKAGE_FILE_CACHE") == "1":
+        cache_file = os.path.join(
+            PACKAGE_FILE_CACHE, hashlib.sha256(key.encode()).hexdigest())
+        try:
+            with open(cache_file, "r") as f:
+                output = f.read()
+        except FileNotFoundError:
+            pass
+
+    if output is None:
+        with timing.phase("cmd", path):
+            output = subprocess.check_output([path]).decode("utf-8")
+        if cache_file is not None:
+            os.makedirs(PACKAGE_FILE_CACHE, exist_ok=True)
+            with fileutil.atomic_write(cache_file) as f:
+                f.write(output)
+
+    _package_file_outputs[key] = output
+    return output
+
+
 def DHEntryPoint(tool_name):
     def wrapper(func):
         def wrapped(self, *args, **kargs):
             self.tool_name = tool_name
-            self.compat()
-            return func(self, *args, **kargs)
+            profiler = timing.start(tool_name)
+            try:
+                with timing.phase("tool", tool_name):
+                    with timing.phase("phase", "startup"):
+                        arch.load_cache(ARCH_CACHE)
+                        self.compat()
+                    try:
+                        result = func(self, *args, **kargs)
+                        self.flush_substvars()
+                    finally:
+                        self._substvars = {}
+                        self.close_installed_logs()
+                    if not self.options.no_act:
+                        arch.save_cache(ARCH_CACHE)
+            finally:
+                timing.stop()
+                if profiler is not None:
+                    # Must not replace an exception raised by the tool
+                    if not getattr(self.options, "no_act", False):
+                        try:
+                            profiler.write()
+                        except OSError as e:
+                            print("%s: warning: could not write profile: %s"
+                                  % (tool_name, e), file=self.stderr)
+                    profiler.print_summary(self.stderr)
+            return result
 
         return wrapped
     return wrapper
@@ -62,6 +151,8 @@ class DHCommon:
         self.stderr = sys.stderr
         self.stderr_b = sys.stderr
         self._compat = None
+        self._installed_logs = {}
+        self._substvars = {}
 
     def _parse_args(self, parser, args, known):
         if known:
@@ -82,13 +173,13 @@ class DHCommon:
 
     def compat(self):
         if self._compat is None:
-            with open("debian/control", "r") as f:
-                source, _ = deb822.read_control(f)
+            source, _ = self.read_control()
             try:
                 deps = source["Build-Depends"]
             except KeyError:
                 deps = None
             if deps:
+                import debian.deb822
                 deps_parsed = debian.deb822.PkgRelation.parse_relations(deps)
                 for dep in deps_parsed:
                     for subdep in dep:
@@ -165,31 +256,37 @@ class DHCommon:
             "-O", action="append",
             help="Pass additional arguments to called programs",
             dest="options")
+        parser.add_argument(
+            "--max-parallel", action="store", type=int,
+            help="Run at most this many jobs in parallel")
 
         # More arguments
         parser.add_argument(
             "-B", "--builddirectory", action="store",
-            help="Build directory for out of source building",
-            default="obj-"
-            + arch.dpkg_architecture()["DEB_HOST_GNU_TYPE"])
+            help="Build directory for out of source building")
 
-    def print_cmd(self, args, cwd=None):
+    def print_cmd(self, args, cwd=None, file=None):
         if self.options.verbose:
             args = list(args)
             if cwd:
                 args = ["cd", cwd, "&&"] + args
             print_args = (format_arg_for_print(a) for a in args)
-            print("\t" + " ".join(print_args), file=self.stdout)
+            print("\t" + " ".join(print_args), file=file or self.stdout)
 
     def do_cmd(self, args, env=None, cwd=None):
         self.print_cmd(args, cwd)
         if not self.options.no_act:
-            subprocess.run(args, stdout=self.stdout, stderr=self.stderr,
-                           env=env, cwd=cwd, check=True)
+            with timing.phase("cmd", " ".join(args)):
+                subprocess.run(args, stdout=self.stdout, stderr=self.stderr,
+                               env=env, cwd=cwd, check=True)
+
+    def read_control(self):
+        from dhcmake import deb822
+        with timing.phase("phase", "read_control"):
+            return deb822.read_control_file("debian/control")
 
     def get_all_packages(self):
-        with open("debian/control", "r") as f:
-            source, packages = deb822.read_control(f)
+        source, packages = self.read_control()
 
         result = []
 
@@ -238,9 +335,7 @@ class DHCommon:
         if self.options.mainpackage:
             return self.options.mainpackage
         else:
-            with open("debian/control", "r") as f:
-                source, packages = deb822.read_control(f)
-
+            source, packages = self.read_control()
             return packages[0]["package"]
 
     def get_package_file(self, package, extension):
@@ -261,12 +356,21 @@ class DHCommon:
         if path is None:
             return None
         elif os.access(path, os.X_OK):
-            return io.StringIO(subprocess.check_output(
-                [os.path.abspath(path)]).decode("utf-8"))
+            return io.StringIO(run_package_file(path))
         else:
             return open(path, "r")
 
+    def get_parallel(self):
+        parallel = get_deb_build_parallel() or 1
+        if self.options.max_parallel:
+            parallel = min(parallel, self.options.max_parallel)
+        return parallel
+
     def get_build_directory(self):
+        if self.options.builddirectory is None:
+            # Only computed when needed, it requires dpkg-architecture
+            self.options.builddirectory = \
+                "obj-" + arch.dpkg_architecture()["DEB_HOST_GNU_TYPE"]
         return self.options.builddirectory
 
     def get_tmpdir(self, package):
@@ -281,24 +385,71 @@ class DHCommon:
         else:
             filename = "debian/substvars"
 
-        line = "%s=%s" % (name, value)
-        self.print_cmd(["echo", line, ">>", filename])
+        # Merged into the file by flush_substvars() at the end of the command
+        if self.options.verbose:
+            print("\t# Setting %s=%s in %s" % (name, value, filename),
+                  file=self.stdout)
         if not self.options.no_act:
-            with open(filename, "a") as f:
-                print(line, file=f)
+            self._substvars.setdefault(filename, {})[name] = value
+
+    def flush_substvars(self):
+        # Merge the buffered variables into each substvars file, replacing
+        # any earlier line for the same variable so that reruns do not keep
+        # appending duplicates
+        substvars = self._substvars
+        self._substvars = {}
+        for filename, variables in substvars.items():
+            lines = []
+            seen = set()
+            try:
+                with open(filename, "r") as f:
+                    for line in f:
+                        if not line.endswith("\n"):
+                            line += "\n"
+                        name = re.split("\\??=", line, maxsplit=1)[0]
+                        if name not in variables:
+                            lines.append(line)
+                        elif name not in seen:
+                            seen.add(name)
+                            lines.append("%s=%s\n" % (name, variables[name]))
+            except FileNotFoundError:
+                pass
+            for name, value in variables.items():
+                if name not in seen:
+                    lines.append("%s=%s\n" % (name, value))
+
+            with fileutil.atomic_write(filename, prefix=".substvars.") as f:
+                f.writelines(lines)
+
+    def get_installed_log(self, package):
+        key = (package, self.tool_name)
+        try:
+            return self._installed_logs[key]
+        except KeyError:
+            pass
+
+        pkgdir = "debian/.debhelper/generated/%s" % package
+        os.makedirs(pkgdir, exist_ok=True)
+        f = open(os.path.join(pkgdir, "installed-by-%s" % self.tool_name),
+                 "a")
+        self._installed_logs[key] = f
+        return f
+
+    def close_installed_logs(self):
+        installed_logs = self._installed_logs
+        self._installed_logs = {}
+        for f in installed_logs.values():
+            f.close()
 
     def log_installed_files(self, package, paths):
         if self.options.no_act:
             return
-        pkgdir = "debian/.debhelper/generated/%s" % package
-        os.makedirs(pkgdir, exist_ok=True)
-        with open(os.path.join(pkgdir, "installed-by-%s" % self.tool_name),
-                  "a") as f:
-            for p in paths:
-                f.write("%s\n" % p)
+        f = self.get_installed_log(package)
+        f.writelines("%s\n" % p for p in paths)
+        f.flush()
 
-    def do_cmake_install(self, builddir, package, component=None, subdir=None,
-                         extra_args=None):
+    def get_cmake_install_cmd(self, builddir, package, component=None,
+                              subdir=None, extra_args=None):
         build_subdir = builddir
         if subdir:
             build_subdir = os.path.join(builddir, subdir)
@@ -309,20 +460,148 @@ class DHCommon:
             args += extra_args
         env = os.environ.copy()
         env["DESTDIR"] = os.path.abspath(self.get_tmpdir(package))
-        self.do_cmd(args, env=env)
+        return args, env
 
+    def get_install_manifest(self, builddir, component=None):
         if component:
             install_manifest = "install_manifest_%s.txt" % component
         else:
             install_manifest = "install_manifest.txt"
-        have_manifest = True
+        return os.path.join(builddir, install_manifest)
+
+    def iter_install_manifest(self, f):
+        prefix = os.path.join(self.options.sourcedir, "")
+        for l in f:
+            path = l.rstrip("\n")
+            if path.startswith("/"):
+                # Same as os.path.relpath(path, "/"), without the overhead
+                path = os.path.normpath(path).lstrip("/") or "."
+            else:
+                path = os.path.relpath(path, "/")
+            yield prefix + path
+
+    def log_install_manifest(self, package, install_manifest, keep=None):
         try:
-            with open(os.path.join(builddir, install_manifest)) as f:
-                files = [os.path.join(self.options.sourcedir,
-                                      os.path.relpath(l.rstrip("\n"), "/"))
-                         for l in f]
+            with open(install_manifest) as f, \
+                    timing.phase("phase", "log_install_manifest",
+                                 package=package):
+                self.log_installed_files(package,
+                                         self.iter_install_manifest(f))
         except FileNotFoundError:
-            have_manifest = False
-        if have_manifest:
-            os.unlink(os.path.join(builddir, install_manifest))
-            self.log_installed_files(package, files)
+            return False
+        if keep:
+            os.makedirs(os.path.dirname(keep), exist_ok=True)
+            os.replace(install_manifest, keep)
+        else:
+            os.unlink(install_manifest)
+        return True
+
+    def get_kept_install_manifest(self, builddir, package, component=None):
+        # Where to keep the install manifest instead of deleting it
+        return None
+
+    def do_cmake_install(self, builddir, package, component=None, subdir=None,
+                         extra_args=None):
+        args, env = self.get_cmake_install_cmd(builddir, package, component,
+                                               subdir, extra_args)
+        self.do_cmd(args, env=env)
+
+        self.log_install_manifest(
+            package, self.get_install_manifest(builddir, component),
+            keep=self.get_kept_install_manifest(builddir, package, component))
+
+    async def _do_cmake_install_job(self, runner, index, builddir, package,
+                                    component=None, subdir=None,
+                                    extra_args=None):
+        args, env = self.get_cmake_install_cmd(builddir, package, component,
+                                               subdir, extra_args)
+        stdout = io.StringIO()
+        self.print_cmd(args, file=stdout)
+        stderr = ""
+        error = None
+        if not self.options.no_act:
+            with timing.phase("cmd", " ".join(args)):
+                returncode, out, err = await runner.run_cmd(args, env=env)
+            stdout.write(out.decode("utf-8", "replace"))
+            stderr = err.decode("utf-8", "replace")
+            if returncode:
+                error = subprocess.CalledProcessError(returncode, args)
+
+        # Move the manifest out of the way before the next install in the
+        # chain overwrites it. It is logged later, once every job is done.
+        install_manifest = None
+        if error is None:
+            install_manifest = "%s.dh-cmake-%i" % (
+                self.get_install_manifest(builddir, component), index)
+            try:
+                os.rename(self.get_install_manifest(builddir, component),
+                          install_manifest)
+            except FileNotFoundError:
+                install_manifest = None
+        return stdout.getvalue(), stderr, install_manifest, error
+
+    def do_cmake_installs(self, installs):
+        installs = list(installs)
+        parallel = self.get_parallel()
+        if parallel <= 1 or len(installs) <= 1:
+            for install in installs:
+                self.do_cmake_install(**install)
+            return
+
+        # Installs which write the same install manifest must not overlap, so
+        # each chain of them runs serially.
+        chains = {}
+        for index, install in enumerate(installs):
+            install_manifest = self.get_install_manifest(
+                install["builddir"], install.get("component"))
+            chains.setdefault(install_manifest, []).append(index)
+
+        from dhcmake import jobs
+
+        runner = jobs.JobRunner(parallel)
+        results = [None] * len(installs)
+
+        def make_job(index):
+            async def job():
+                results[index] = await self._do_cmake_install_job(
+                    runner, index, **installs[index])
+                if results[index][3] is not None:
+                    raise results[index][3]
+            return job
+
+        # The renamed install manifests are removed whatever goes wrong,
+        # including errors which are not about a failed install
+        try:
+            try:
+                runner.run_chains([[make_job(index) for index in indices]
+                                   for indices in chains.values()])
+            except subprocess.CalledProcessError:
+                # Raised again below, after the output of the earlier
+                # installs
+                pass
+
+            # Report in the original order so the output and the
+            # installed-by logs do not depend on scheduling.
+            for install, result in zip(installs, results):
+                if result is None:
+                    continue
+                stdout, stderr, install_manifest, error = result
+                self.stdout.write(stdout)
+                self.stdout.flush()
+                self.stderr.write(stderr)
+                self.stderr.flush()
+                if error is not None:
+                    raise error
+                if install_manifest is not None:
+                    self.log_install_manifest(
+                        install["package"], install_manifest,
+                        keep=self.get_kept_install_manifest(
+                            install["builddir"], install["package"],
+                            install.get("component")))
+        finally:
+            for result in results:
+                if result is not None and result[2] is not None:
+                    try:
+                        os.unlink(result[2])
+                    except FileNotFoundError:
+                        pass
@@ -2,17 +2,236 @@
 # BSD 3-Clause license. See top-level LICENSE file or
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
+import hashlib
 import json
 import os.path
 import re
+import sys
+
+from dhcmake import common, fileutil, timing
+
+
+CPACK_METADATA = "debian/.cpack/cpack-metadata.json"
+CPACK_METADATA_FINGERPRINT = "debian/.cpack/dh-cmake-fingerprint.json"
+CPACK_METADATA_FORMAT_VERSION_MAJOR = 1
+
+
+def get_cpack_group_closures(component_groups):
+    # Iterative depth-first walk, so that deep group hierarchies cannot hit
+    # the recursion limit. Groups are finished in topological order (every
+    # subgroup before its parents), so each closure only needs the already
+    # computed closures of its direct subgroups.
+    order = []
+    closures = {}
+    visiting = set()
+
+    for root in component_groups:
+        if root in closures:
+            continue
+
+        visiting.add(root)
+        stack = [(root, iter(component_groups[root]["subgroups"]))]
+        while stack:
+            group, sub_groups = stack[-1]
+            for sub_group in sub_groups:
+                if sub_group in closures:
+                    continue
+                if sub_group in visiting:
+                    cycle = [g for g, _ in stack]
+                    cycle = cycle[cycle.index(sub_group):] + [sub_group]
+                    raise ValueError("Cycle in CPack component groups: %s" %
+                                     " -> ".join(cycle))
+                if sub_group not in component_groups:
+                    raise ValueError(
+                        "Invalid CPack component group %s in group %s" %
+                        (sub_group, group))
+                visiting.add(sub_group)
+                stack.append((sub_group, iter(
+                    component_groups[sub_group]["subgroups"])))
+                break
+            else:
+                stack.pop()
+                visiting.remove(group)
+                all_components = set(component_groups[group]["components"])
+                for sub_group in component_groups[group]["subgroups"]:
+                    all_components.update(closures[sub_group])
+                closures[group] = frozenset(all_components)
+                order.append(group)
+
+    return order, closures
+
+
+class CPackMetadataError(ValueError):
+    pass
+
+
+def _get_field(obj, key, types, where, default=None, required=True):
+    try:
+        value = obj[key]
+    except KeyError:
+        if required:
+            raise CPackMetadataError("Missing field %s in %s" % (key, where))
+        return default
+    if not isinstance(value, types):
+        raise CPackMetadataError("Invalid field %s in %s" % (key, where))
+    return value
+
+
+def _get_names(obj, key, where, required=True):
+    names = _get_field(obj, key, list, where, [], required)
+    for name in names:
+        if not isinstance(name, str):
+            raise CPackMetadataError("Invalid field %s in %s" % (key, where))
+    return tuple(sys.intern(name) for name in names)
+
+
+class CPackComponent:
+    __slots__ = ("name", "group", "dependencies")
+
+    def __init__(self, name, group, dependencies):
+        self.name = name
+        self.group = group
+        self.dependencies = dependencies
+
+
+class CPackComponentGroup:
+    __slots__ = ("name", "parent_group", "components", "subgroups",
+                 "all_components")
+
+    def __init__(self, name, parent_group, components, subgroups):
+        self.name = name
+        self.parent_group = parent_group
+        self.components = components
+        self.subgroups = subgroups
+        self.all_components = frozenset()
+
+
+class CPackProject:
+    __slots__ = ("name", "directory", "sub_directory", "component",
+                 "components")
+
+    def __init__(self, name, directory, sub_directory, component, components):
+        self.name = name
+        self.directory = directory
+        self.sub_directory = sub_directory
+        self.component = component
+        self.components = components
+
+
+class CPackMetadata:
+    __slots__ = ("components", "component_groups", "projects", "build_type",
+                 "strip_files", "group_order", "component_projects")
+
+    def __init__(self, data):
+        # Validate the whole document up front, so that a malformed or
+        # unexpected file fails here with a clear message rather than with a
+        # KeyError somewhere in the middle of an install
+        if not isinstance(data, dict):
+            raise CPackMetadataError("Invalid CPack metadata")
+        version = _get_field(data, "formatVersionMajor", int, "CPack metadata")
+        if version != CPACK_METADATA_FORMAT_VERSION_MAJOR:
+            raise CPackMetadataError(
+                "Unsupported CPack metadata format version %s" % version)
+
+        self.components = {}
+        for name, component in _get_field(
+                data, "components", dict, "CPack metadata").items():
+            where = "CPack component %s" % name
+            if not isinstance(component, dict):
+                raise CPackMetadataError("Invalid %s" % where)
+            name = sys.intern(name)
+            group = _get_field(component, "group", str, where,
+                               required=False)
+            self.components[name] = CPackComponent(
+                name, group and sys.intern(group),
+                _get_names(component, "dependencies", where))
+
+        groups = _get_field(data, "componentGroups", dict, "CPack metadata")
+        self.component_groups = {}
+        for name, group in groups.items():
+            where = "CPack component group %s" % name
+            if not isinstance(group, dict):
+                raise CPackMetadataError("Invalid %s" % where)
+            name = sys.intern(name)
+            parent_group = _get_field(group, "parentGroup", str, where,
+                                      required=False)
+            self.component_groups[name] = CPackComponentGroup(
+                name, parent_group and sys.intern(parent_group),
+                _get_names(group, "components", where),
+                _get_names(group, "subgroups", where))
+
+        self.group_order, closures = get_cpack_group_closures(groups)
+        for name, closure in closures.items():
+            self.component_groups[name].all_components = closure
+
+        self.projects = []
+        self.component_projects = {}
+        for index, project in enumerate(
+                _get_field(data, "projects", list, "CPack metadata")):
+            where = "CPack project %i" % index
+            if not isinstance(project, dict):
+                raise CPackMetadataError("Invalid %s" % where)
+            project = CPackProject(
+                _get_field(project, "projectName", str, where),
+                _get_field(project, "directory", str, where),
+                _get_field(project, "subDirectory", str, where, "/", False),
+                _get_field(project, "component", str, where, "ALL", False),
+                _get_names(project, "components", where))
+            self.projects.append(project)
+            for component in project.components:
+                self.component_projects.setdefault(component, []) \
+                    .append(project)
+
+        self.build_type = _get_field(data, "buildType", str, "CPack metadata",
+                                     required=False)
+        self.strip_files = _get_field(data, "stripFiles", bool,
+                                      "CPack metadata", False, False)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                raise CPackMetadataError("Invalid CPack metadata in %s: %s" %
+                                         (path, e))
+        try:
+            return cls(data)
+        except CPackMetadataError as e:
+            raise CPackMetadataError("%s: %s" % (path, e))
+
+
+class CPackComponentGraph:
+    def __init__(self, cpack_metadata, package_components):
+        self.cpack_metadata = cpack_metadata
+        self.package_components = package_components
+        self.component_packages = {}
+        for package, components in package_components.items():
+            for component in components:
+                self.component_packages.setdefault(component, set()) \
+                    .add(package)
+
+    def get_component_dependencies(self, components):
+        deps = set()
+
+        for component in components:
+            for component_dep in \
+                    self.cpack_metadata.components[component].dependencies:
+                deps.update(self.component_packages.get(component_dep, ()))
 
-from dhcmake import common
+        return deps
 
 
 class DHCPack(common.DHCommon):
+    def __init__(self):
+        super().__init__()
+        self.cpack_metadata = None
+        self.cpack_graph = None
+
     def read_cpack_metadata(self):
-        with open("debian/.cpack/cpack-metadata.json", "r") as f:
-            self.cpack_metadata = json.load(f)
+        with timing.phase("phase", "read_cpack_metadata"):
+            self.cpack_metadata = CPackMetadata.load(CPACK_METADATA)
+        self.cpack_graph = None
 
     def get_cpack_components(self, package):
         opened_file = self.read_package_file(package, "cpack-components")
@@ -22,7 +241,7 @@ class DHCPack(common.DHCommon):
                 for l in f:
                     if not re.search("^($|#)", l):
                         group = l.rstrip()
-                        if group in self.cpack_metadata["components"]:
+                        if group in self.cpack_metadata.components:
                             retval.append(group)
                         else:
                             raise ValueError(
@@ -39,7 +258,7 @@ class DHCPack(common.DHCommon):
                 for l in f:
                     if not re.search("^($|#)", l):
                         group = l.rstrip()
-                        if group in self.cpack_metadata["componentGroups"]:
+                        if group in self.cpack_metadata.component_groups:
                             retval.append(group)
                         else:
                             raise ValueError(
@@ -49,23 +268,8 @@ class DHCPack(common.DHCommon):
         else:
             return []
 
-    def get_all_cpack_components_for_group(self, group, visited=None):
-        if visited is None:
-            visited = set()
-
-        if group in visited:
-            return set()
-        visited.add(group)
-
-        all_components = set(self.cpack_metadata["componentGroups"][group]
-                             ["components"])
-
-        for sub_group in self.cpack_metadata["componentGroups"][group]["subgroups"]:
-            all_components.update(
-                self.get_all_cpack_components_for_group(
-                    sub_group, visited))
-
-        return all_components
+    def get_all_cpack_components_for_group(self, group):
+        return self.cpack_metadata.component_groups[group].all_components
 
     def get_all_cpack_components(self, package):
         all_components = set(self.get_cpack_components(package))
@@ -76,21 +280,80 @@ class DHCPack(common.DHCommon):
 
         return all_components
 
-    def get_package_dependencies(self, package):
-        deps = set()
+    def get_cpack_component_projects(self):
+        return self.cpack_metadata.component_projects
 
-        for component in self.get_all_cpack_components(package):
-            for component_dep in self.cpack_metadata["components"][component]["dependencies"]:
-                for other_package in self.get_packages():
-                    if component_dep in \
-                            self.get_all_cpack_components(other_package):
-                        deps.add(other_package)
+    def get_cpack_graph(self):
+        if self.cpack_graph is None:
+            self.cpack_graph = CPackComponentGraph(
+                self.cpack_metadata,
+                {package: self.get_all_cpack_components(package)
+                 for package in self.get_packages()})
+        return self.cpack_graph
 
-        return deps
+    def get_package_dependencies(self, package):
+        graph = self.get_cpack_graph()
+        try:
+            components = graph.package_components[package]
+        except KeyError:
+            components = self.get_all_cpack_components(package)
+
+        return graph.get_component_dependencies(components)
+
+    def get_cpack_config_fingerprint(self, config, cmd_args):
+        # Hash CPackConfig.cmake, every CMake file it refers to, and the
+        # install scripts of the projects it packages, which is everything
+        # that the generated metadata can depend on
+        h = hashlib.sha256()
+        files = [os.path.abspath(config)]
+        seen = set(files)
+        while files:
+            path = files.pop(0)
+            try:
+                with open(path, "rb") as f:
+                    contents = f.read()
+            except FileNotFoundError:
+                contents = None
+            h.update(json.dumps([
+                path,
+                None if contents is None
+                else hashlib.sha256(contents).hexdigest(),
+            ]).encode())
+            if contents is None:
+                continue
+
+            contents = contents.decode("utf-8", "replace")
+            referenced = re.findall("\"(/[^\";$]*\\.cmake)\"", contents)
+            for projects in re.findall(
+                    "set\\(CPACK_INSTALL_CMAKE_PROJECTS \"([^\"]*)\"\\)",
+                    contents):
+                referenced.extend(os.path.join(d, "cmake_install.cmake")
+                                  for d in projects.split(";")[::4])
+            for p in referenced:
+                if p not in seen:
+                    seen.add(p)
+                    files.append(p)
+
+        return {"args": cmd_args, "files": h.hexdigest()}
+
+    def cpack_metadata_is_current(self, fingerprint):
+        if not os.path.exists(CPACK_METADATA):
+            return False
+        try:
+            with open(CPACK_METADATA_FINGERPRINT, "r") as f:
+                return json.load(f) == fingerprint
+        except (OSError, ValueError):
+            return False
+
+    def generate_make_arg_parser(self, parser):
+        self.make_arg_parser(parser)
+        parser.add_argument(
+            "--force", action="store_true",
+            help="Run CPack even if its configuration has not changed")
 
     @common.DHEntryPoint("dh_cpack_generate")
     def generate(self, args=None):
-        self.parse_args(args)
+        self.parse_args(args, make_arg_parser=self.generate_make_arg_parser)
 
         cmd_args = [
             "cpack",
@@ -101,7 +364,27 @@ class DHCPack(common.DHCommon):
             "-D", "CPACK_EXT_REQUESTED_VERSIONS=1.0",
             "-B", "debian/.cpack",
         ]
+
+        with timing.phase("phase", "cpack_config_fingerprint"):
+            fingerprint = self.get_cpack_config_fingerprint(cmd_args[2],
+                                                            cmd_args)
+        if self.options.force:
+            reason = "--force was given"
+        elif self.cpack_metadata_is_current(fingerprint):
+            if self.options.verbose:
+                print("\t# CPack configuration unchanged, reusing "
+                      "debian/.cpack/cpack-metadata.json", file=self.stdout)
+            return
+        else:
+            reason = "CPack configuration changed"
+        if self.options.verbose:
+            print("\t# Generating CPack metadata: %s" % reason,
+                  file=self.stdout)
+
         self.do_cmd(cmd_args)
+        if not self.options.no_act:
+            with fileutil.atomic_write(CPACK_METADATA_FINGERPRINT) as f:
+                json.dump(fingerprint, f)
 
     @common.DHEntryPoint("dh_cpack_substvars")
     def substvars(self, args=None):
@@ -127,37 +410,38 @@ class DHCPack(common.DHCommon):
         self.parse_args(args, make_arg_parser=self.install_make_arg_parser)
         self.read_cpack_metadata()
 
+        extra_args = []
+
+        if self.cpack_metadata.build_type is not None:
+            extra_args.extend([
+                "--config",
+                self.cpack_metadata.build_type
+            ])
+
+        # TODO Fix this in CMake (https://gitlab.kitware.com/cmake/cmake/-/issues/20700)
+        # try:
+        #    extra_args.append(
+        #            "-DCMAKE_INSTALL_DEFAULT_"
+        #            "DIRECTORY_PERMISSIONS:STRING=" +
+        #            self.cpack_metadata[
+        #                "defaultDirectoryPermissions"])
+        # except KeyError:
+        #    pass
+
+        if self.cpack_metadata.strip_files:
+            extra_args.append("--strip")
+
+        projects = self.get_cpack_component_projects()
+        graph = self.get_cpack_graph()
+        installs = []
         for package in self.get_packages():
-            for component in self.get_all_cpack_components(package):
-                for project in self.cpack_metadata["projects"]:
-                    if component in project["components"]:
-                        extra_args = []
-
-                        try:
-                            extra_args.extend([
-                                "--config",
-                                self.cpack_metadata["buildType"]
-                            ])
-                        except KeyError:
-                            pass
-
-                        # TODO Fix this in CMake (https://gitlab.kitware.com/cmake/cmake/-/issues/20700)
-                        # try:
-                        #    extra_args.append(
-                        #            "-DCMAKE_INSTALL_DEFAULT_"
-                        #            "DIRECTORY_PERMISSIONS:STRING=" +
-                        #            self.cpack_metadata[
-                        #                "defaultDirectoryPermissions"])
-                        # except KeyError:
-                        #    pass
-
-                        if self.cpack_metadata["stripFiles"]:
-                            extra_args.append("--strip")
-
-                        self.do_cmake_install(
-                            project["directory"], package,
-                            component=component,
-                            extra_args=extra_args)
+            for component in sorted(graph.package_components[package]):
+                for project in projects.get(component, []):
+                    installs.append(dict(
+                        builddir=project.directory, package=package,
+                        component=component, extra_args=extra_args))
+
+        self.do_cmake_installs(installs)
 
 
 def generate():
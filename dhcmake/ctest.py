@@ -2,11 +2,53 @@
 # BSD 3-Clause license. See top-level LICENSE file or
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
+import argparse
+import functools
+import json
 import os.path
-import pkg_resources
 import re
-
-from dhcmake import common
+import shutil
+import subprocess
+import sys
+import time
+
+from dhcmake import common, fileutil, timing
+
+
+# Steps which can run together in a single CTest session, and the commands
+# run by the steps which wrap a dh_auto_* command
+SESSION_STEPS = ["start", "update", "configure", "build", "test", "submit"]
+STEP_COMMANDS = {
+    "configure": "dh_auto_configure",
+    "build": "dh_auto_build",
+}
+
+# The CDash part written by each step, for the outbox
+STEP_PARTS = {
+    "update": "Update",
+    "configure": "Configure",
+    "build": "Build",
+    "test": "Test",
+}
+
+# A failed submission of the outbox is retried, waiting twice as long after
+# each failure, but without holding up the build for more than a few seconds
+SUBMIT_ATTEMPTS = 3
+SUBMIT_RETRY_DELAY = 1.0
+
+# Written by dh_ctest_test in the --ctest-testing-dir, one line per test
+TEST_RESULTS = "test-results.jsonl"
+
+# Relative to the binary directory of the CTest session, which is the build
+# directory for plain ctest and the --ctest-testing-dir for the driver script
+COST_DATA = "Testing/Temporary/CTestCostData.txt"
+
+# The line CTest prints when a test finishes, the same with or without -S:
+#   3/6 Test #3: name ..........***Failed    0.00 sec
+# The output of the tests themselves is prefixed with the test number by -VV.
+_TEST_RESULT_RE = re.compile(
+    r"^ *[0-9]+/[0-9]+ Test +#([0-9]+): (.*?) \.+(?:\*\*\*| +)(.*?) +"
+    r"([0-9.]+) sec$")
 
 
 def format_arg_for_ctest(arg):
@@ -22,57 +64,128 @@ def format_args_for_ctest(args):
     return " ".join(format_arg_for_ctest(a) for a in args)
 
 
-def _get_deb_ctest_options():
-    try:
-        deb_ctest_options = os.environ["DEB_CTEST_OPTIONS"]
-    except KeyError:
-        return []
+def parse_test_result(line):
+    match = _TEST_RESULT_RE.search(line.rstrip("\n"))
+    if not match:
+        return None
+    return {
+        "index": int(match.group(1)),
+        "name": match.group(2),
+        "status": match.group(3),
+        "duration": float(match.group(4)),
+    }
+
+
+class DebCTestOptionsError(ValueError):
+    pass
 
+
+def _split_deb_ctest_options(deb_ctest_options):
     result = []
-    current = ""
+    current = []
     escape = False
     quote = False
     for c in deb_ctest_options:
         if escape:
-            current += c
+            current.append(c)
             escape = False
         elif c == "\\":
             escape = True
         elif c == '"':
             quote = not quote
-        elif re.match("\\s", c) and not quote:
+        elif c.isspace() and not quote:
             if current:
-                result.append(current)
-                current = ""
+                result.append("".join(current))
+                current = []
         else:
-            current += c
+            current.append(c)
 
     if quote:
-        raise ValueError("Unclosed quote")
+        raise DebCTestOptionsError("Unclosed quote")
     if escape:
-        raise ValueError("Unclosed backslash")
+        raise DebCTestOptionsError("Unclosed backslash")
 
     if current:
-        result.append(current)
+        result.append("".join(current))
+    return result
+
+
+# Keyed on the value of DEB_CTEST_OPTIONS, so the variable is only tokenized
+# once no matter how many options are looked up. The result must not be
+# modified.
+@functools.lru_cache(maxsize=None)
+def _parse_deb_ctest_options(deb_ctest_options):
+    result = {}
+    for item in _split_deb_ctest_options(deb_ctest_options):
+        name, sep, value = item.partition("=")
+        result.setdefault(name, value if sep else True)
     return result
 
 
 def get_deb_ctest_option(name):
-    for item in _get_deb_ctest_options():
-        eq_split = item.split("=", 1)
-        if eq_split[0] == name:
-            if len(eq_split) > 1:
-                return eq_split[1]
-            else:
-                return True
+    return _parse_deb_ctest_options(
+        os.environ.get("DEB_CTEST_OPTIONS", "")).get(name)
+
+
+class DebCTestOptions:
+    FLAGS = ("submit", "catchfailed", "update", "outbox")
+    STRINGS = ("model", "site", "track", "revision", "build", "costdata")
+    # Name, description and minimum value
+    INTEGERS = (
+        ("parallel", "parallel level", 1),
+        ("testload", "test load", 0),
+    )
+
+    __slots__ = FLAGS + STRINGS + tuple(name for name, _, _ in INTEGERS)
+
+    def __init__(self, items):
+        for name in items:
+            if name not in self.__slots__:
+                raise DebCTestOptionsError(
+                    "Unknown option %s in DEB_CTEST_OPTIONS" % name)
+
+        for name in self.FLAGS:
+            # Older versions accepted a value, and only an empty one turned
+            # the flag off
+            setattr(self, name, bool(items.get(name, False)))
+
+        for name in self.STRINGS:
+            value = items.get(name)
+            if value is True:
+                raise DebCTestOptionsError(
+                    "Option %s in DEB_CTEST_OPTIONS requires a value" % name)
+            setattr(self, name, value)
 
-    return None
+        for name, description, minimum in self.INTEGERS:
+            value = items.get(name)
+            if value is not None:
+                if value is True or not re.search("^[0-9]+$", value) or \
+                        int(value) < minimum:
+                    raise DebCTestOptionsError(
+                        "Invalid %s in DEB_CTEST_OPTIONS" % description)
+                value = int(value)
+            setattr(self, name, value)
+
+
+@functools.lru_cache(maxsize=None)
+def _load_deb_ctest_options(deb_ctest_options):
+    return DebCTestOptions(_parse_deb_ctest_options(deb_ctest_options))
+
+
+def get_deb_ctest_options():
+    return _load_deb_ctest_options(os.environ.get("DEB_CTEST_OPTIONS", ""))
 
 
 class DHCTest(common.DHCommon):
     def make_arg_parser(self, parser):
         super().make_arg_parser(parser)
+        self.ctest_make_arg_parser(parser)
+        parser.add_argument(
+            "extra_args", nargs="*")
 
+    def ctest_make_arg_parser(self, parser):
+        # The options of the dh_ctest_* commands themselves, as opposed to
+        # the debhelper options which they pass on to dh_auto_*
         parser.add_argument(
             "--no-submit", action="store_true",
             help="Don't submit after each part")
@@ -85,68 +198,282 @@ class DHCTest(common.DHCommon):
         parser.add_argument(
             "--ctest-build-suffix", action="store", default="",
             help="Suffix to add to CTest build")
-        parser.add_argument(
-            "extra_args", nargs="*")
 
     def get_dh_ctest_driver(self):
-        return pkg_resources.resource_filename(__name__,
-                                               "dh_ctest_driver.cmake")
-
-    def do_ctest_step(self, step, cmd=None):
-        dashboard_model = get_deb_ctest_option("model")
+        import importlib.resources
+        return str(importlib.resources.files(__package__)
+                   .joinpath("dh_ctest_driver.cmake"))
+
+    @property
+    def deb_ctest_options(self):
+        return get_deb_ctest_options()
+
+    def get_test_parallel(self):
+        parallel = self.deb_ctest_options.parallel
+        if parallel is None:
+            return self.get_parallel()
+
+        if self.options.max_parallel:
+            parallel = min(parallel, self.options.max_parallel)
+        return parallel
+
+    def get_test_load(self):
+        if self.options.test_load is not None:
+            return self.options.test_load
+        return self.deb_ctest_options.testload
+
+    def get_test_args(self):
+        # Definitions for the driver script, and arguments for plain ctest
+        defines = []
+        ctest_args = []
+        parallel = self.get_test_parallel()
+        if parallel > 1:
+            defines.append("-DDH_CTEST_PARALLEL_LEVEL:STRING=%i" % parallel)
+            ctest_args.extend(["-j", str(parallel)])
+        test_load = self.get_test_load()
+        if test_load is not None:
+            defines.append("-DDH_CTEST_TEST_LOAD:STRING=%i" % test_load)
+            ctest_args.extend(["--test-load", str(test_load)])
+        return defines, ctest_args
+
+    def get_ctest_driver_args(self, dashboard_model):
+        args = [
+            "ctest", "-VV", "-S", self.get_dh_ctest_driver(),
+            "-DDH_CTEST_SRCDIR:PATH=" + os.getcwd(),
+            "-DDH_CTEST_CTESTDIR:PATH=" + os.path.join(
+                os.getcwd(), self.options.ctest_testing_dir),
+            "-DDH_CTEST_BUILDDIR:PATH=" + self.get_build_directory(),
+            "-DDH_CTEST_DASHBOARD_MODEL:STRING=" + dashboard_model,
+        ]
+        deb_ctest_options = self.deb_ctest_options
+        if deb_ctest_options.submit and not deb_ctest_options.outbox and \
+                not self.options.no_submit:
+            args.append("-DDH_CTEST_STEP_SUBMIT:BOOL=ON")
+
+        if deb_ctest_options.site is not None:
+            args.append("-DDH_CTEST_SITE:STRING=" + deb_ctest_options.site)
+
+        if deb_ctest_options.track is not None:
+            args.append("-DDH_CTEST_TRACK:STRING=" + deb_ctest_options.track)
+
+        if deb_ctest_options.revision is not None:
+            args.append("-DDH_CTEST_VERSION_OVERRIDE:STRING=" +
+                        deb_ctest_options.revision)
+
+        build = deb_ctest_options.build
+        if self.options.ctest_build:
+            build = self.options.ctest_build
+        if self.options.ctest_build_suffix:
+            build += self.options.ctest_build_suffix
+        if build is not None:
+            args.append("-DDH_CTEST_BUILD:STRING=" + build)
+
+        catchfailed = "0"
+        if deb_ctest_options.catchfailed:
+            catchfailed = "1"
+        args.append("-DDH_CTEST_CATCHFAILED:BOOL=" + catchfailed)
+        return args
+
+    def do_ctest_step(self, step, cmd=None, defines=None):
+        dashboard_model = self.deb_ctest_options.model
         if dashboard_model is None:
             if cmd is not None:
                 self.do_cmd([cmd, *self.parsed_args])
             return False
         else:
-            args = [
-                "ctest", "-VV", "-S", self.get_dh_ctest_driver(),
-                "-DDH_CTEST_SRCDIR:PATH=" + os.getcwd(),
-                "-DDH_CTEST_CTESTDIR:PATH=" + os.path.join(
-                    os.getcwd(), self.options.ctest_testing_dir),
-                "-DDH_CTEST_BUILDDIR:PATH=" + self.get_build_directory(),
-                "-DDH_CTEST_DASHBOARD_MODEL:STRING=" + dashboard_model,
-                "-DDH_CTEST_STEP:STRING=" + step,
-            ]
+            args = self.get_ctest_driver_args(dashboard_model)
+            args.append("-DDH_CTEST_STEP:STRING=" + step)
             if cmd:
                 args.append("-DDH_CTEST_RUN_CMD:STRING="
                             + format_args_for_ctest([cmd, *self.parsed_args]))
-            if get_deb_ctest_option("submit") and not self.options.no_submit:
-                args.append("-DDH_CTEST_STEP_SUBMIT:BOOL=ON")
-
-            site = get_deb_ctest_option("site")
-            if isinstance(site, str):
-                args.append("-DDH_CTEST_SITE:STRING=" + site)
-
-            track = get_deb_ctest_option("track")
-            if isinstance(track, str):
-                args.append("-DDH_CTEST_TRACK:STRING=" + track)
-
-            revision = get_deb_ctest_option("revision")
-            if isinstance(revision, str):
-                args.append("-DDH_CTEST_VERSION_OVERRIDE:STRING=" + revision)
-
-            build = get_deb_ctest_option("build")
-            if self.options.ctest_build:
-                build = self.options.ctest_build
-            if self.options.ctest_build_suffix:
-                build += self.options.ctest_build_suffix
-            if isinstance(build, str):
-                args.append("-DDH_CTEST_BUILD:STRING=" + build)
-
-            catchfailed = "0"
-            if get_deb_ctest_option("catchfailed"):
-                catchfailed = "1"
-            args.append("-DDH_CTEST_CATCHFAILED:BOOL=" + catchfailed)
+            if defines:
+                args.extend(defines)
 
             if step == "submit" and self.options.parts:
                 args.append("-DDH_CTEST_SUBMIT_PARTS:STRING=" +
                             ";".join(self.options.parts))
 
             args.extend(self.options.extra_args)
-            self.do_cmd(args)
+            try:
+                if step == "test":
+                    self.do_test_cmd(args)
+                else:
+                    self.do_cmd(args)
+            finally:
+                # Also queue the results of a failed step, like the driver
+                # submits them before failing
+                if step in STEP_PARTS:
+                    self.queue_step_parts([step])
+            return True
+
+    def get_test_labels(self):
+        with timing.phase("cmd", "ctest --show-only=json-v1"):
+            try:
+                output = subprocess.run(
+                    ["ctest", "--show-only=json-v1"],
+                    cwd=self.get_build_directory(), stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL, check=True).stdout
+                tests = json.loads(output)["tests"]
+            except (OSError, subprocess.CalledProcessError, ValueError,
+                    KeyError):
+                return {}
+
+        labels = {}
+        for test in tests:
+            for prop in test.get("properties", []):
+                if prop.get("name") == "LABELS":
+                    labels[test.get("name")] = prop.get("value", [])
+        return labels
+
+    def do_test_cmd(self, args, cwd=None):
+        # Like do_cmd(), but writes the result of each test to TEST_RESULTS
+        # as soon as CTest reports it
+        self.print_cmd(args, cwd)
+        if self.options.no_act:
+            return
+
+        path = os.path.join(self.options.ctest_testing_dir, TEST_RESULTS)
+        os.makedirs(self.options.ctest_testing_dir, exist_ok=True)
+        # Only looked up once the first test has finished, so that the tests
+        # of a configure step in the same session are known
+        labels = None
+        with timing.phase("cmd", " ".join(args)), \
+                open(path, "w") as results, \
+                subprocess.Popen(args, stdout=subprocess.PIPE,
+                                 stderr=self.stderr, cwd=cwd, text=True,
+                                 errors="replace") as process:
+            for line in process.stdout:
+                self.stdout.write(line)
+                self.stdout.flush()
+                result = parse_test_result(line)
+                if result is not None:
+                    if labels is None:
+                        labels = self.get_test_labels()
+                    result["labels"] = labels.get(result["name"], [])
+                    results.write(json.dumps(result, sort_keys=True) + "\n")
+                    results.flush()
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, args)
+
+    def get_cost_data_path(self):
+        if self.deb_ctest_options.model is None:
+            return os.path.join(self.get_build_directory(), COST_DATA)
+        return os.path.join(self.options.ctest_testing_dir, COST_DATA)
+
+    def get_cost_data_cache(self):
+        # Shared by every build of the same source package
+        cache_dir = self.deb_ctest_options.costdata
+        if cache_dir is None:
+            return None
+        source, _ = self.read_control()
+        return os.path.join(cache_dir, source["Source"] + ".txt")
+
+    def restore_cost_data(self):
+        cache = self.get_cost_data_cache()
+        if cache is None or self.options.no_act:
+            return
+
+        # Cost data from an earlier run in the same tree is more recent
+        path = self.get_cost_data_path()
+        if os.path.exists(path) or not os.path.exists(cache):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        shutil.copyfile(cache, path)
+
+    def save_cost_data(self):
+        cache = self.get_cost_data_cache()
+        if cache is None or self.options.no_act:
+            return
+
+        path = self.get_cost_data_path()
+        if not os.path.exists(path):
+            return
+        # Other builds of the same source may be reading it
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with fileutil.atomic_write(
+                cache, "wb", prefix=".CTestCostData.") as f, \
+                open(path, "rb") as cost_data:
+            shutil.copyfileobj(cost_data, f)
+
+    def get_outbox_dir(self):
+        return os.path.join(self.options.ctest_testing_dir, "outbox")
+
+    def get_testing_tag_dir(self):
+        testing_dir = os.path.join(self.options.ctest_testing_dir, "Testing")
+        try:
+            with open(os.path.join(testing_dir, "TAG"), "r") as f:
+                tag = next(f).rstrip()
+        except (FileNotFoundError, StopIteration):
+            return None
+        return os.path.join(testing_dir, tag)
+
+    def queue_parts(self, parts=None):
+        # Copy the XML files of the given CDash parts, or of every part, to
+        # the outbox
+        tag_dir = self.get_testing_tag_dir()
+        if tag_dir is None or self.options.no_act:
+            return
+
+        if parts is None:
+            filenames = sorted(f for f in os.listdir(tag_dir)
+                               if f.endswith(".xml"))
+        else:
+            filenames = [part + ".xml" for part in parts]
+
+        outbox_dir = self.get_outbox_dir()
+        os.makedirs(outbox_dir, exist_ok=True)
+        for filename in filenames:
+            path = os.path.join(tag_dir, filename)
+            if os.path.exists(path):
+                shutil.copyfile(path, os.path.join(outbox_dir, filename))
+
+    def queue_step_parts(self, steps):
+        deb_ctest_options = self.deb_ctest_options
+        if deb_ctest_options.outbox and deb_ctest_options.submit and \
+                not self.options.no_submit:
+            self.queue_parts([STEP_PARTS[step] for step in steps
+                              if step in STEP_PARTS])
+
+    def flush_outbox(self):
+        # Never fails the build: whatever could not be submitted stays in
+        # the outbox for the next dh_ctest_submit or dh_ctest_steps
+        outbox_dir = self.get_outbox_dir()
+        try:
+            filenames = sorted(f for f in os.listdir(outbox_dir)
+                               if f.endswith(".xml"))
+        except FileNotFoundError:
+            filenames = []
+        if not filenames:
+            return True
+
+        paths = [os.path.join(os.getcwd(), outbox_dir, f) for f in filenames]
+        args = self.get_ctest_driver_args(self.deb_ctest_options.model)
+        args.append("-DDH_CTEST_STEP:STRING=submit_outbox")
+        args.append("-DDH_CTEST_SUBMIT_FILES:STRING=" + ";".join(paths))
+
+        delay = SUBMIT_RETRY_DELAY
+        for attempt in range(SUBMIT_ATTEMPTS):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+            try:
+                self.do_cmd(args)
+            except subprocess.CalledProcessError:
+                continue
+
+            if not self.options.no_act:
+                for path in paths:
+                    os.remove(path)
             return True
 
+        print("%s: warning: could not submit to CDash after %i attempts, "
+              "leaving %i file%s in %s" % (
+                  self.tool_name, SUBMIT_ATTEMPTS, len(paths),
+                  "" if len(paths) == 1 else "s", outbox_dir),
+              file=self.stderr)
+        return False
+
     @common.DHEntryPoint("dh_ctest_clean")
     def clean(self, args=None):
         self.parse_args(args)
@@ -155,53 +482,160 @@ class DHCTest(common.DHCommon):
     @common.DHEntryPoint("dh_ctest_start")
     def start(self, args=None):
         self.parse_args(args)
+        if self.deb_ctest_options.outbox:
+            # Anything left over belongs to the previous dashboard
+            self.do_cmd(["rm", "-rf", self.get_outbox_dir() + "/"])
         self.do_ctest_step("start")
 
     @common.DHEntryPoint("dh_ctest_update")
     def update(self, args=None):
         self.parse_args(args)
-        if get_deb_ctest_option("update"):
+        if self.deb_ctest_options.update:
             self.do_ctest_step("update")
 
     @common.DHEntryPoint("dh_ctest_configure")
     def configure(self, args=None):
         self.parse_args(args)
-        self.do_ctest_step("configure", "dh_auto_configure")
+        self.do_ctest_step("configure", STEP_COMMANDS["configure"])
 
     @common.DHEntryPoint("dh_ctest_build")
     def build(self, args=None):
         self.parse_args(args)
-        self.do_ctest_step("build", "dh_auto_build")
+        self.do_ctest_step("build", STEP_COMMANDS["build"])
+
+    def test_make_arg_parser(self, parser):
+        self.make_arg_parser(parser)
+        self.test_options_make_arg_parser(parser)
+
+    def test_options_make_arg_parser(self, parser):
+        parser.add_argument(
+            "--test-load", action="store", type=int,
+            help="Don't start new tests while the CPU load is above this")
 
     @common.DHEntryPoint("dh_ctest_test")
     def test(self, args=None):
-        self.parse_args(args)
-        if not self.do_ctest_step("test"):
-            self.do_cmd(["ctest", "-VV", *self.options.extra_args],
-                        cwd=self.get_build_directory())
+        self.parse_args(args, make_arg_parser=self.test_make_arg_parser)
+
+        defines, ctest_args = self.get_test_args()
+        self.restore_cost_data()
+        try:
+            if not self.do_ctest_step("test", defines=defines):
+                self.do_test_cmd(["ctest", "-VV", *ctest_args,
+                                  *self.options.extra_args],
+                                 cwd=self.get_build_directory())
+        finally:
+            self.save_cost_data()
+
+    def steps_make_arg_parser(self, parser, submit=False):
+        self.test_make_arg_parser(parser)
+        if submit:
+            self.parts_make_arg_parser(parser)
+
+    def get_step_command_args(self, submit=False):
+        # Everything but the options of dh_ctest_steps itself, which
+        # dh_auto_* would reject
+        parser = argparse.ArgumentParser(add_help=False)
+        self.ctest_make_arg_parser(parser)
+        self.test_options_make_arg_parser(parser)
+        if submit:
+            self.parts_make_arg_parser(parser)
+        return parser.parse_known_args(self.parsed_args)[1]
+
+    @common.DHEntryPoint("dh_ctest_steps")
+    def steps(self, steps, args=None):
+        for step in steps:
+            if step not in SESSION_STEPS:
+                raise ValueError("Unknown step: %s" % step)
+        submit = "submit" in steps
+        self.parse_args(args, make_arg_parser=functools.partial(
+            self.steps_make_arg_parser, submit=submit))
+        parts = self.options.parts if submit else None
+        step_command_args = self.get_step_command_args(submit)
+
+        # Same conditions as dh_ctest_update and dh_ctest_submit
+        if not self.deb_ctest_options.update:
+            steps = [step for step in steps if step != "update"]
+        if not self.deb_ctest_options.submit:
+            steps = [step for step in steps if step != "submit"]
+
+        defines, ctest_args = [], []
+        if "test" in steps:
+            defines, ctest_args = self.get_test_args()
+
+        dashboard_model = self.deb_ctest_options.model
+        if dashboard_model is None:
+            for step in steps:
+                if step in STEP_COMMANDS:
+                    self.do_cmd([STEP_COMMANDS[step], *step_command_args])
+                elif step == "test":
+                    self.restore_cost_data()
+                    try:
+                        self.do_test_cmd(["ctest", "-VV", *ctest_args,
+                                          *self.options.extra_args],
+                                         cwd=self.get_build_directory())
+                    finally:
+                        self.save_cost_data()
+            return
+
+        outbox_submit = self.deb_ctest_options.outbox and "submit" in steps
+        if outbox_submit:
+            steps = [step for step in steps if step != "submit"]
+        if self.deb_ctest_options.outbox and "start" in steps:
+            self.do_cmd(["rm", "-rf", self.get_outbox_dir() + "/"])
+
+        # Run every step in one session of the driver script, instead of
+        # starting CTest and reloading the dashboard state for each of them
+        args = self.get_ctest_driver_args(dashboard_model)
+        args.append("-DDH_CTEST_STEPS:STRING=" + ";".join(steps))
+        for step in steps:
+            if step in STEP_COMMANDS:
+                args.append(
+                    "-DDH_CTEST_RUN_CMD_%s:STRING=" % step +
+                    format_args_for_ctest([STEP_COMMANDS[step],
+                                           *step_command_args]))
+        if "submit" in steps and parts:
+            args.append("-DDH_CTEST_SUBMIT_PARTS:STRING=" + ";".join(parts))
+        args.extend(defines)
+        args.extend(self.options.extra_args)
+        if "test" in steps:
+            self.restore_cost_data()
+        try:
+            if "test" in steps:
+                self.do_test_cmd(args)
+            else:
+                self.do_cmd(args)
+        finally:
+            self.queue_step_parts(steps)
+            if "test" in steps:
+                self.save_cost_data()
+
+        if outbox_submit:
+            self.queue_parts(parts)
+            self.flush_outbox()
 
     def submit_make_arg_parser(self, parser):
         super().make_arg_parser(parser)
+        self.ctest_make_arg_parser(parser)
+        self.parts_make_arg_parser(parser)
 
-        parser.add_argument(
-            "--ctest-testing-dir", action="store", default="debian/.ctest",
-            help="Directory in which to store CTest Testing/ directory")
-        parser.add_argument(
-            "--ctest-build", action="store",
-            help="Name of the CTest build")
-        parser.add_argument(
-            "--ctest-build-suffix", action="store", default="",
-            help="Suffix to add to CTest build")
+    def parts_make_arg_parser(self, parser):
         parser.add_argument("--parts", action="store", nargs="*",
                             help="Parts to submit to CDash")
 
     @common.DHEntryPoint("dh_ctest_submit")
     def submit(self, args=None):
         self.parse_args(args, make_arg_parser=self.submit_make_arg_parser)
+        # Accepted like by the other dh_ctest_* commands, but this one
+        # always submits
         self.options.no_submit = False
         self.options.extra_args = []
-        if get_deb_ctest_option("submit"):
-            self.do_ctest_step("submit")
+        if self.deb_ctest_options.submit:
+            if self.deb_ctest_options.outbox and \
+                    self.deb_ctest_options.model is not None:
+                self.queue_parts(self.options.parts)
+                self.flush_outbox()
+            else:
+                self.do_ctest_step("submit")
 
 
 def clean():
@@ -237,3 +671,33 @@ def test():
 def submit():
     dhctest = DHCTest()
     dhctest.submit()
+
+
+def parse_steps(steps):
+    result = []
+    for step in steps.split(","):
+        step = step.strip()
+        for prefix in ("dh_ctest_", "ctest_"):
+            if step.startswith(prefix):
+                step = step[len(prefix):]
+        if step not in SESSION_STEPS:
+            raise ValueError("Unknown step: %s" % step)
+        result.append(step)
+    return result
+
+
+def steps():
+    if len(sys.argv) < 2:
+        print("Usage: %s step[,step...] [options]" % sys.argv[0],
+              file=sys.stderr)
+        print("Steps: %s" % ", ".join(SESSION_STEPS), file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        session_steps = parse_steps(sys.argv[1])
+    except ValueError as e:
+        print("%s: %s" % (sys.argv[0], e), file=sys.stderr)
+        sys.exit(2)
+
+    dhctest = DHCTest()
+    dhctest.steps(session_steps, sys.argv[2:])
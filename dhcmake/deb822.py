@@ -2,19 +2,40 @@
 # BSD 3-Clause license. See top-level LICENSE file or
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
+import os
 import re
 
 import debian.deb822
 
 
 def read_control(sequence, *args, **kwargs):
-    iterator = debian.deb822.Deb822.iter_paragraphs(sequence, *args, **kwargs)
-    source = ControlSource(next(iterator).dump())
-    packages = [ControlPackage(p.dump()) for p in iterator]
+    iterator = ControlPackage.iter_paragraphs(sequence, *args, **kwargs)
+    source = ControlSource(next(iterator))
+    packages = list(iterator)
 
     return source, packages
 
 
+_control_cache = dict()
+
+
+def read_control_file(path):
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (st.st_ino, st.st_mtime_ns, st.st_size)
+    try:
+        cached_key, result = _control_cache[path]
+        if cached_key == key:
+            return result
+    except KeyError:
+        pass
+
+    with open(path, "r") as f:
+        result = read_control(f)
+    _control_cache[path] = (key, result)
+    return result
+
+
 class ControlSource(debian.deb822.Deb822):
     pass
 
@@ -25,68 +25,116 @@ function(step_submit)
   endif()
 endfunction()
 
-if(DH_CTEST_STEP STREQUAL start)
-
-  set(_track_args)
-  if(DEFINED DH_CTEST_TRACK)
-    set(_track_args TRACK "${DH_CTEST_TRACK}")
+# These are macros rather than functions, because ctest_start() reads
+# CTestConfig.cmake into the current scope, and ctest_submit() needs it.
+# Only the first step of a session needs to reload the dashboard state from
+# the Testing/ directory.
+macro(start_append)
+  get_property(_started GLOBAL PROPERTY DH_CTEST_STARTED)
+  if(NOT _started)
+    ctest_start("${DH_CTEST_DASHBOARD_MODEL}" APPEND)
+    set_property(GLOBAL PROPERTY DH_CTEST_STARTED TRUE)
   endif()
-  ctest_start("${DH_CTEST_DASHBOARD_MODEL}" ${_track_args})
-
-elseif(DH_CTEST_STEP STREQUAL update)
-
-  set(CTEST_UPDATE_VERSION_ONLY TRUE)
-  set(CTEST_UPDATE_VERSION_OVERRIDE)
-  set(CTEST_UPDATE_COMMAND)
-  if(DEFINED DH_CTEST_VERSION_OVERRIDE)
-    set(CTEST_UPDATE_VERSION_OVERRIDE "${DH_CTEST_VERSION_OVERRIDE}")
-    # TODO No way to specify "no tool", so we have to specify something even
-    # though it won't actually be used. Fix this in CMake upstream.
-    set(CTEST_UPDATE_COMMAND /usr/bin/git)
+endmacro()
+
+macro(run_step step)
+  set(_step "${step}")
+  if(DEFINED DH_CTEST_RUN_CMD_${step})
+    set(_run_cmd "${DH_CTEST_RUN_CMD_${step}}")
+  else()
+    set(_run_cmd "${DH_CTEST_RUN_CMD}")
   endif()
 
-  ctest_start("${DH_CTEST_DASHBOARD_MODEL}" APPEND)
-  ctest_update(CAPTURE_CMAKE_ERROR _result)
+  if(_step STREQUAL start)
 
-  step_submit(Update)
+    set(_track_args)
+    if(DEFINED DH_CTEST_TRACK)
+      set(_track_args TRACK "${DH_CTEST_TRACK}")
+    endif()
+    ctest_start("${DH_CTEST_DASHBOARD_MODEL}" ${_track_args})
+    set_property(GLOBAL PROPERTY DH_CTEST_STARTED TRUE)
 
-elseif(DH_CTEST_STEP STREQUAL configure)
+  elseif(_step STREQUAL update)
 
-  set(CTEST_CONFIGURE_COMMAND "${DH_CTEST_RUN_CMD}")
-  ctest_start("${DH_CTEST_DASHBOARD_MODEL}" APPEND)
-  ctest_configure(BUILD "${DH_CTEST_SRCDIR}")
+    set(CTEST_UPDATE_VERSION_ONLY TRUE)
+    set(CTEST_UPDATE_VERSION_OVERRIDE)
+    set(CTEST_UPDATE_COMMAND)
+    if(DEFINED DH_CTEST_VERSION_OVERRIDE)
+      set(CTEST_UPDATE_VERSION_OVERRIDE "${DH_CTEST_VERSION_OVERRIDE}")
+      # TODO No way to specify "no tool", so we have to specify something even
+      # though it won't actually be used. Fix this in CMake upstream.
+      set(CTEST_UPDATE_COMMAND /usr/bin/git)
+    endif()
 
-  step_submit(Configure)
+    start_append()
+    ctest_update(CAPTURE_CMAKE_ERROR _result)
 
-elseif(DH_CTEST_STEP STREQUAL build)
+    step_submit(Update)
 
-  set(CTEST_BUILD_COMMAND "${DH_CTEST_RUN_CMD}")
-  ctest_start("${DH_CTEST_DASHBOARD_MODEL}" APPEND)
-  ctest_build(BUILD "${DH_CTEST_SRCDIR}")
+  elseif(_step STREQUAL configure)
 
-  step_submit(Build)
+    set(CTEST_CONFIGURE_COMMAND "${_run_cmd}")
+    start_append()
+    ctest_configure(BUILD "${DH_CTEST_SRCDIR}")
 
-elseif(DH_CTEST_STEP STREQUAL test)
+    step_submit(Configure)
 
-  ctest_start("${DH_CTEST_DASHBOARD_MODEL}" APPEND)
-  ctest_test(BUILD "${DH_CTEST_BUILDDIR}" RETURN_VALUE _result)
+  elseif(_step STREQUAL build)
 
-  step_submit(Test)
+    set(CTEST_BUILD_COMMAND "${_run_cmd}")
+    start_append()
+    ctest_build(BUILD "${DH_CTEST_SRCDIR}")
 
-  if(DH_CTEST_CATCHFAILED AND _result)
-    message(FATAL_ERROR
-      "One or more tests failed and DEB_CTEST_OPTIONS=catchfailed was set. "
-      "Aborting.")
-  endif()
+    step_submit(Build)
 
-elseif(DH_CTEST_STEP STREQUAL submit)
+  elseif(_step STREQUAL test)
 
-  ctest_start("${DH_CTEST_DASHBOARD_MODEL}" APPEND)
+    set(_test_args)
+    if(DEFINED DH_CTEST_PARALLEL_LEVEL)
+      list(APPEND _test_args PARALLEL_LEVEL "${DH_CTEST_PARALLEL_LEVEL}")
+    endif()
+    if(DEFINED DH_CTEST_TEST_LOAD)
+      list(APPEND _test_args TEST_LOAD "${DH_CTEST_TEST_LOAD}")
+    endif()
 
-  if(DEFINED DH_CTEST_SUBMIT_PARTS)
-    ctest_submit(PARTS ${DH_CTEST_SUBMIT_PARTS})
-  else()
-    ctest_submit()
-  endif()
+    start_append()
+    ctest_test(BUILD "${DH_CTEST_BUILDDIR}" ${_test_args} RETURN_VALUE _result)
+
+    step_submit(Test)
 
+    if(DH_CTEST_CATCHFAILED AND _result)
+      message(FATAL_ERROR
+        "One or more tests failed and DEB_CTEST_OPTIONS=catchfailed was set. "
+        "Aborting.")
+    endif()
+
+  elseif(_step STREQUAL submit)
+
+    start_append()
+
+    if(DEFINED DH_CTEST_SUBMIT_PARTS)
+      ctest_submit(PARTS ${DH_CTEST_SUBMIT_PARTS})
+    else()
+      ctest_submit()
+    endif()
+
+  elseif(_step STREQUAL submit_outbox)
+
+    # Retried by dh_ctest_submit, which needs to know if this failed
+    start_append()
+    ctest_submit(FILES ${DH_CTEST_SUBMIT_FILES} RETURN_VALUE _result)
+    if(_result)
+      message(FATAL_ERROR "Could not submit the outbox to CDash.")
+    endif()
+
+  endif()
+endmacro()
+
+# DH_CTEST_STEPS runs several steps in a single session, DH_CTEST_STEP just one
+if(DEFINED DH_CTEST_STEPS)
+  foreach(_step IN LISTS DH_CTEST_STEPS)
+    run_step("${_step}")
+  endforeach()
+else()
+  run_step("${DH_CTEST_STEP}")
 endif()
@@ -0,0 +1,32 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import contextlib
+import os
+
+
+@contextlib.contextmanager
+def atomic_write(filename, mode="w", prefix=None):
+    # Readers of filename see either the old or the new contents, and the
+    # permissions of the old file are kept. tempfile is imported here because
+    # it is too slow to import when a dh_* command starts, and most of them
+    # never write a file this way.
+    import tempfile
+
+    try:
+        permissions = os.stat(filename).st_mode & 0o7777
+    except FileNotFoundError:
+        permissions = 0o644
+
+    with tempfile.NamedTemporaryFile(
+            mode, dir=os.path.dirname(filename) or ".", prefix=prefix,
+            delete=False) as f:
+        try:
+            yield f
+        except BaseException:
+            f.close()
+            os.unlink(f.name)
+            raise
+    os.chmod(f.name, permissions)
+    os.replace(f.name, filename)
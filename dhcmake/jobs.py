@@ -0,0 +1,58 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import asyncio
+import subprocess
+
+
+class JobRunner:
+    def __init__(self, parallel):
+        self.parallel = max(parallel, 1)
+        self.semaphore = None
+
+    async def run_cmd(self, args, env=None, cwd=None):
+        # Output is captured rather than passed through, so that the caller
+        # can write out each job's output in one piece
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                env=env, cwd=cwd)
+            try:
+                stdout, stderr = await proc.communicate()
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+        return proc.returncode, stdout, stderr
+
+    async def _run_chain(self, chain):
+        for job in chain:
+            await job()
+
+    async def _run_chains(self, chains):
+        self.semaphore = asyncio.Semaphore(self.parallel)
+        tasks = [asyncio.ensure_future(self._run_chain(chain))
+                 for chain in chains]
+        if not tasks:
+            return
+
+        # Stop at the first failure, and kill whatever the other chains are
+        # still running
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        for task in tasks:
+            if task in done and task.exception() is not None:
+                raise task.exception()
+
+    def run_chains(self, chains):
+        # Each chain is a list of coroutine functions which run one after the
+        # other. Separate chains run concurrently, with at most self.parallel
+        # commands running at once.
+        asyncio.run(self._run_chains(chains))
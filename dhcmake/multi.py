@@ -0,0 +1,111 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import argparse
+import functools
+import sys
+
+from dhcmake import cmake, common, cpack, ctest
+
+
+STEPS = {
+    "cmake_install": (cmake.DHCMake, "install"),
+    "cpack_generate": (cpack.DHCPack, "generate"),
+    "cpack_substvars": (cpack.DHCPack, "substvars"),
+    "cpack_install": (cpack.DHCPack, "install"),
+    "ctest_clean": (ctest.DHCTest, "clean"),
+    "ctest_start": (ctest.DHCTest, "start"),
+    "ctest_update": (ctest.DHCTest, "update"),
+    "ctest_configure": (ctest.DHCTest, "configure"),
+    "ctest_build": (ctest.DHCTest, "build"),
+    "ctest_test": (ctest.DHCTest, "test"),
+    "ctest_submit": (ctest.DHCTest, "submit"),
+}
+
+
+def parse_steps(steps):
+    result = []
+    for step in steps.split(","):
+        step = step.strip()
+        if step.startswith("dh_"):
+            step = step[3:]
+        if step not in STEPS:
+            raise ValueError("Unknown step: %s" % step)
+        result.append(step)
+    return result
+
+
+def get_ctest_session_step(step):
+    if step.startswith("ctest_") and step[6:] in ctest.SESSION_STEPS:
+        return step[6:]
+    return None
+
+
+def group_steps(steps):
+    # Two or more consecutive CTest steps are run by dh_ctest_steps, in a
+    # single CTest session
+    groups = []
+    index = 0
+    while index < len(steps):
+        end = index
+        while end < len(steps) and get_ctest_session_step(steps[end]):
+            end += 1
+        if end - index > 1:
+            groups.append(
+                ("ctest_steps", [get_ctest_session_step(step)
+                                 for step in steps[index:end]]))
+            index = end
+        else:
+            groups.append((steps[index], None))
+            index += 1
+    return groups
+
+
+def check_args(args):
+    # Only the debhelper options are understood by every step. Anything
+    # else has to go in -O, which the steps that don't know it ignore.
+    parser = argparse.ArgumentParser(add_help=False)
+    common.DHCommon().make_arg_parser(parser)
+    _, unknown = parser.parse_known_args(args)
+    if unknown:
+        raise ValueError(
+            "Not accepted by every step: %s (pass step-specific options "
+            "with -O)" % " ".join(unknown))
+
+
+def run_steps(steps, args, stdout=None, stderr=None):
+    # Every step gets a fresh object, exactly as if its own dh_* command had
+    # been run, but the parsed debian/control and the dpkg-architecture
+    # results are cached per process and shared between all steps.
+    check_args(args)
+    for step, session_steps in group_steps(steps):
+        if session_steps is not None:
+            dh = ctest.DHCTest()
+            run = functools.partial(dh.steps, session_steps)
+        else:
+            cls, method = STEPS[step]
+            dh = cls()
+            run = getattr(dh, method)
+        if stdout is not None:
+            dh.stdout = dh.stdout_b = stdout
+        if stderr is not None:
+            dh.stderr = dh.stderr_b = stderr
+        run(list(args))
+
+
+def multi():
+    if len(sys.argv) < 2:
+        print("Usage: %s step[,step...] [options]" % sys.argv[0],
+              file=sys.stderr)
+        print("Steps: %s" % ", ".join(STEPS), file=sys.stderr)
+        sys.exit(2)
+
+    try:
+        steps = parse_steps(sys.argv[1])
+        check_args(sys.argv[2:])
+    except ValueError as e:
+        print("%s: %s" % (sys.argv[0], e), file=sys.stderr)
+        sys.exit(2)
+
+    run_steps(steps, sys.argv[2:])
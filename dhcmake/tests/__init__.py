@@ -36,6 +36,38 @@ class VolatileNamedTemporaryFile:
         self.close()
 
 
+class PushEnvironmentVariable:
+    def __init__(self, name, value):
+        self.name = name
+        try:
+            self.old_value = os.environ[name]
+        except KeyError:
+            self.old_value = None
+
+        os.environ[name] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.old_value is None:
+            del os.environ[self.name]
+        else:
+            os.environ[self.name] = self.old_value
+
+
+FAKE_TOOLS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              "data", "fake_tools")
+
+
+class PushFakeTools(PushEnvironmentVariable):
+    # Puts the stand-ins for cmake, cpack, ctest and dpkg-architecture in
+    # data/fake_tools first on PATH
+    def __init__(self):
+        super().__init__(
+            "PATH", FAKE_TOOLS_DIR + os.pathsep + os.environ.get("PATH", ""))
+
+
 class KWTestCaseBase(TestCase):
     @classmethod
     def setUpClass(cls):
@@ -198,3 +230,125 @@ class VolatileNamedTemporaryFileTestCase(KWTestCaseBase):
         with VolatileNamedTemporaryFile() as f:
             os.unlink(f.name)
         self.assertVolatileFileNotExists(f.name)
+
+
+class PushEnvironmentVariableTestCase(KWTestCaseBase):
+    varname = "DH_CMAKE_TEST_VARIABLE_DO_NOT_SET"
+
+    def test_create_new(self):
+        try:
+            del os.environ[self.varname]
+        except KeyError:
+            pass
+
+        with PushEnvironmentVariable(self.varname, "value"):
+            self.assertEqual("value", os.environ[self.varname])
+
+        self.assertNotIn(self.varname, os.environ)
+
+    def test_change(self):
+        os.environ[self.varname] = "old"
+
+        with PushEnvironmentVariable(self.varname, "new"):
+            self.assertEqual("new", os.environ[self.varname])
+
+        self.assertEqual("old", os.environ[self.varname])
+
+
+class FakeToolsTestCase(KWTestCaseBase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tmp_dir.name, "log")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def run_fake(self, args, env=None, **kwargs):
+        with PushFakeTools():
+            env = dict(os.environ, **(env or {}))
+            env["DH_CMAKE_FAKE_LOG"] = self.log
+            return subprocess.run(args, env=env, stdout=subprocess.PIPE,
+                                  check=True, **kwargs).stdout.decode()
+
+    def test_path(self):
+        with PushFakeTools():
+            self.assertEqual(os.path.join(FAKE_TOOLS_DIR, "cmake"),
+                             shutil.which("cmake"))
+        self.assertNotEqual(os.path.join(FAKE_TOOLS_DIR, "cmake"),
+                            shutil.which("cmake"))
+
+    def test_cmake_install_recorded(self):
+        builddir = os.path.join(self.tmp_dir.name, "build")
+        destdir = os.path.join(self.tmp_dir.name, "dest")
+        os.makedirs(os.path.join(builddir, "fake-install"))
+        with open(os.path.join(builddir, "fake-install", "Headers"), "w") as f:
+            f.write("/usr/include/a.h\n/usr/include/b/c.h\n")
+
+        self.run_fake(["cmake", "--install", builddir, "--component",
+                       "Headers", "--config", "Release"],
+                      env={"DESTDIR": destdir})
+
+        self.assertFileExists(os.path.join(destdir, "usr/include/a.h"))
+        self.assertFileExists(os.path.join(destdir, "usr/include/b/c.h"))
+        self.assertFileContentsEqual(
+            "/usr/include/a.h\n/usr/include/b/c.h\n",
+            os.path.join(builddir, "install_manifest_Headers.txt"))
+        self.assertFileContentsEqual(
+            "cmake --install %s --component Headers --config Release\n" %
+            builddir, self.log)
+
+    def test_cmake_install_generated(self):
+        builddir = self.tmp_dir.name
+        self.run_fake(["cmake", "--install", builddir],
+                      env={"DH_CMAKE_FAKE_MANIFEST_LINES": "2"})
+
+        self.assertFileContentsEqual(
+            "/usr/share/all/file0\n/usr/share/all/file1\n",
+            os.path.join(builddir, "install_manifest.txt"))
+
+    def test_cpack(self):
+        builddir = os.path.join(self.tmp_dir.name, "build")
+        os.mkdir(builddir)
+        with open(os.path.join(builddir, "fake-cpack-metadata.json"),
+                  "w") as f:
+            f.write("{}\n")
+
+        self.run_fake([
+            "cpack", "--config", os.path.join(builddir, "CPackConfig.cmake"),
+            "-G", "External", "-D", "CPACK_PACKAGE_FILE_NAME=metadata",
+            "-B", "out",
+        ], cwd=self.tmp_dir.name)
+
+        self.assertFileContentsEqual(
+            "{}\n", os.path.join(self.tmp_dir.name, "out/metadata.json"))
+
+    def test_ctest(self):
+        self.run_fake(["ctest", "-VV"])
+        self.assertFileContentsEqual("ctest -VV\n", self.log)
+
+        with self.assertRaises(subprocess.CalledProcessError):
+            self.run_fake(["ctest"], env={"DH_CMAKE_FAKE_CTEST_EXIT": "8"})
+
+    def test_dpkg_architecture(self):
+        values = dict(line.split("=", 1) for line in
+                      self.run_fake(["dpkg-architecture"]).splitlines())
+        self.assertEqual("amd64", values["DEB_HOST_ARCH"])
+        self.assertEqual("x86_64-linux-gnu", values["DEB_HOST_GNU_TYPE"])
+
+        self.assertEqual("arm64\n", self.run_fake(
+            ["dpkg-architecture", "-q", "DEB_HOST_ARCH"],
+            env={"DEB_HOST_ARCH": "arm64"}))
+
+        self.run_fake(["dpkg-architecture", "-i", "any-amd64", "-a", "amd64",
+                       "-f"])
+        self.run_fake(["dpkg-architecture", "-i", "any-arm", "-a", "armhf",
+                       "-f"])
+        for alias, real, returncode in [
+            ("armhf", "amd64", 1),
+            ("linux-any", "hurd-i386", 1),
+            ("any-amd64", "mips64el", 2),
+        ]:
+            with self.assertRaises(subprocess.CalledProcessError) as cm:
+                self.run_fake(["dpkg-architecture", "-i", alias, "-a", real,
+                               "-f"], stderr=subprocess.DEVNULL)
+            self.assertEqual(returncode, cm.exception.returncode)
@@ -0,0 +1,112 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import os.path
+import subprocess
+import tempfile
+
+from dhcmake import arch
+from . import KWTestCaseBase, PushEnvironmentVariable
+
+
+class ArchTestCase(KWTestCaseBase):
+    @staticmethod
+    def dpkg_architecture_list(wildcard=None):
+        args = ["dpkg-architecture", "-L"]
+        if wildcard:
+            args += ["-W", wildcard]
+        proc = subprocess.run(args, stdout=subprocess.PIPE, check=True)
+        return set(proc.stdout.decode().split())
+
+    def test_debarch_to_debtuple(self):
+        self.assertEqual(("eabihf", "gnu", "linux", "arm"),
+                         arch.debarch_to_debtuple("armhf"))
+        self.assertEqual(("base", "gnu", "linux", "amd64"),
+                         arch.debarch_to_debtuple("linux-amd64"))
+        self.assertEqual(("base", "gnu", "hurd", "i386"),
+                         arch.debarch_to_debtuple("hurd-i386"))
+        self.assertIsNone(arch.debarch_to_debtuple("not-an-arch"))
+
+    def test_debwildcard_to_debtuple(self):
+        self.assertEqual(("any", "any", "any", "any"),
+                         arch.debwildcard_to_debtuple("any"))
+        self.assertEqual(("any", "any", "linux", "any"),
+                         arch.debwildcard_to_debtuple("linux-any"))
+        self.assertEqual(("any", "musl", "linux", "any"),
+                         arch.debwildcard_to_debtuple("musl-linux-any"))
+        self.assertEqual(("eabihf", "gnu", "linux", "arm"),
+                         arch.debwildcard_to_debtuple("armhf"))
+
+    def test_debarch_contains(self):
+        self.assertTrue(arch.debarch_contains("armhf", ["arm64", "armhf"]))
+        self.assertTrue(arch.debarch_contains("armhf", ["any-arm"]))
+        self.assertTrue(arch.debarch_contains("amd64", ["linux-any"]))
+        self.assertFalse(arch.debarch_contains("amd64", ["hurd-any", "i386"]))
+
+    def test_debarch_is_matches_dpkg_architecture(self):
+        archs = self.dpkg_architecture_list()
+        debtuples = [arch.debarch_to_debtuple(a) for a in archs]
+        self.assertNotIn(None, debtuples)
+
+        wildcards = {"any", "any-any", "any-any-any", "any-any-any-any"}
+        for abi, libc, os_name, cpu in debtuples:
+            wildcards.update([
+                "any-" + cpu,
+                os_name + "-any",
+                libc + "-" + os_name + "-any",
+                abi + "-" + libc + "-" + os_name + "-any",
+                "any-any-" + os_name + "-any",
+            ])
+        aliases = sorted(wildcards) + [
+            "amd64", "linux-amd64", "armhf", "hurd-i386", "kfreebsd-amd64",
+            "musl-linux-arm64", "x32", "any-linux-arm", "any-hurd-i386",
+        ]
+
+        for alias in aliases:
+            expected = self.dpkg_architecture_list(alias)
+            actual = {a for a in archs if arch.debarch_is(a, alias)}
+            self.assertEqual(expected, actual, msg="Wildcard %s" % alias)
+
+
+class ArchCacheTestCase(KWTestCaseBase):
+    def setUp(self):
+        self.old_known_archs = dict(arch._known_archs)
+        self.old_dpkg_architecture_values = arch._dpkg_architecture_values
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache = os.path.join(self.tmp_dir.name, ".debhelper/cache.json")
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+        arch._known_archs.clear()
+        arch._known_archs.update(self.old_known_archs)
+        arch._dpkg_architecture_values = self.old_dpkg_architecture_values
+
+    def reset(self):
+        arch._known_archs.clear()
+        arch._dpkg_architecture_values = None
+
+    def test_save_load(self):
+        self.reset()
+        values = dict(arch.dpkg_architecture())
+        self.assertTrue(arch.debarch_is("armhf", "linux-any"))
+        arch.save_cache(self.cache)
+        self.assertFileExists(self.cache)
+
+        self.reset()
+        self.assertTrue(arch.load_cache(self.cache))
+        self.assertEqual(values, arch._dpkg_architecture_values)
+        self.assertEqual({("armhf", "linux-any"): True}, arch._known_archs)
+
+    def test_load_changed_environment(self):
+        self.reset()
+        arch.dpkg_architecture()
+        arch.save_cache(self.cache)
+
+        self.reset()
+        with PushEnvironmentVariable("DEB_HOST_ARCH", "armhf"):
+            self.assertFalse(arch.load_cache(self.cache))
+        self.assertIsNone(arch._dpkg_architecture_values)
+
+    def test_load_missing(self):
+        self.assertFalse(arch.load_cache(self.cache))
@@ -0,0 +1,298 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+# Benchmarks for dh-cmake on synthetic projects. Run with
+#
+#   python3 -m dhcmake.tests.benchmark [--scenario NAME] [--output FILE]
+#
+# to get the results as JSON. cmake, cpack and dpkg-architecture are replaced
+# by the stand-ins in data/fake_tools.
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from dhcmake import arch, common, cpack, deb822
+from . import KWTestCaseBase, PushEnvironmentVariable, PushFakeTools
+
+
+SCENARIOS = {
+    "small": dict(packages=1, components=10, depth=2, manifest_lines=10,
+                  log_lines=100),
+    "medium": dict(packages=50, components=500, depth=10,
+                   manifest_lines=1000, log_lines=100000),
+    "large": dict(packages=500, components=5000, depth=50,
+                  manifest_lines=1000, log_lines=1000000),
+}
+
+
+def write_project(path, packages, components, depth, manifest_lines,
+                  log_lines):
+    # Components are spread over the packages round-robin. Each component
+    # depends on the previous one and on one about half-way down, and
+    # belongs to one of a chain of "depth" nested groups. The last package
+    # pulls in the outermost group, and with it every component.
+    os.makedirs(os.path.join(path, "debian/.cpack"))
+    os.makedirs(os.path.join(path, "build"))
+
+    package_names = ["libbench%i" % i for i in range(packages)]
+    component_names = ["Component%i" % i for i in range(components)]
+    group_names = ["Group%i" % i for i in range(depth)]
+
+    with open(os.path.join(path, "debian/control"), "w") as f:
+        f.write("Source: bench\n"
+                "Maintainer: Benchmark <bench@example.com>\n"
+                "Build-Depends: dh-cmake-compat (= 1), dh-cmake\n")
+        for name in package_names:
+            f.write("\nPackage: %s\n"
+                    "Architecture: any\n"
+                    "Depends: ${cpack:Depends}\n"
+                    "Description: %s\n"
+                    " %s\n" % (name, name, name))
+
+    for index, name in enumerate(package_names):
+        with open(os.path.join(path, "debian/%s.cpack-components" % name),
+                  "w") as f:
+            for component in component_names[index::packages]:
+                f.write(component + "\n")
+    with open(os.path.join(
+            path, "debian/%s.cpack-component-groups" % package_names[-1]),
+            "w") as f:
+        f.write(group_names[0] + "\n")
+
+    metadata = {
+        "formatVersionMajor": 1,
+        "formatVersionMinor": 0,
+        "stripFiles": False,
+        "components": {},
+        "componentGroups": {},
+        "projects": [{
+            "projectName": "bench",
+            "directory": os.path.join(path, "build"),
+            "subDirectory": "/",
+            "component": "ALL",
+            "components": component_names,
+        }],
+    }
+    for index, name in enumerate(component_names):
+        metadata["components"][name] = {
+            "name": name,
+            "group": group_names[index % depth],
+            "dependencies": sorted({component_names[i] for i in
+                                    (index - 1, index // 2) if i < index}),
+        }
+    for index, name in enumerate(group_names):
+        group = {
+            "name": name,
+            "components": component_names[index::depth],
+            "subgroups": group_names[index + 1:index + 2],
+        }
+        if index:
+            group["parentGroup"] = group_names[index - 1]
+        metadata["componentGroups"][name] = group
+    # Recorded for the fake cpack, and already generated for the benchmarks
+    # which only read it
+    for metadata_file in ("build/fake-cpack-metadata.json",
+                          "debian/.cpack/cpack-metadata.json"):
+        with open(os.path.join(path, metadata_file), "w") as f:
+            json.dump(metadata, f)
+    with open(os.path.join(path, "build/CPackConfig.cmake"), "w") as f:
+        pass
+
+    # A single big install manifest, linked into place for each run because
+    # log_install_manifest() removes it
+    with open(os.path.join(path, "build/bench-install-manifest.txt"),
+              "w") as f:
+        for i in range(log_lines):
+            f.write("/usr/share/bench/dir%i/file%i\n" % (i % 100, i))
+
+
+def reset_caches():
+    # Keep what a real build keeps between commands (the architecture cache
+    # is stored on disk), but drop what only lives for one command
+    deb822._control_cache.clear()
+    common._package_file_outputs.clear()
+
+
+def measure(func, repeat, stdout):
+    times = []
+    for i in range(repeat):
+        reset_caches()
+        start = time.perf_counter()
+        func(stdout)
+        times.append(time.perf_counter() - start)
+    return {
+        "repeat": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "max": max(times),
+    }
+
+
+def make_dh(stdout, args=None):
+    dh = cpack.DHCPack()
+    dh.stdout = stdout
+    dh.parse_args(args or [], make_arg_parser=dh.install_make_arg_parser)
+    return dh
+
+
+def bench_generate(stdout):
+    make_dh(stdout).generate(["--force", "--builddirectory", "build"])
+
+
+def bench_get_packages(stdout):
+    make_dh(stdout).get_packages()
+
+
+def bench_get_package_dependencies(stdout):
+    dh = make_dh(stdout)
+    dh.read_cpack_metadata()
+    for package in dh.get_packages():
+        dh.get_package_dependencies(package)
+
+
+def bench_substvars(stdout):
+    make_dh(stdout).substvars([])
+
+
+def bench_install(stdout):
+    make_dh(stdout).install([])
+
+
+def bench_log_install_manifest(stdout):
+    dh = make_dh(stdout)
+    dh.tool_name = "dh_bench_log_install_manifest"
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink("debian/.debhelper/generated/libbench0/"
+                  "installed-by-dh_bench_log_install_manifest")
+    os.link("build/bench-install-manifest.txt", "build/install_manifest.txt")
+    dh.log_install_manifest("libbench0", "build/install_manifest.txt")
+    dh.close_installed_logs()
+
+
+def bench_startup(stdout):
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    subprocess.run([sys.executable, "-c",
+                    "from dhcmake.cpack import substvars; substvars()"],
+                   env=env, stdout=stdout, check=True)
+
+
+BENCHMARKS = [
+    ("generate", bench_generate),
+    ("get_packages", bench_get_packages),
+    ("get_package_dependencies", bench_get_package_dependencies),
+    ("substvars", bench_substvars),
+    ("install", bench_install),
+    ("log_install_manifest", bench_log_install_manifest),
+    ("startup", bench_startup),
+]
+
+
+@contextlib.contextmanager
+def chdir(path):
+    old_cwd = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old_cwd)
+
+
+def run_scenario(name, repeat, benchmarks=None):
+    parameters = SCENARIOS[name]
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir, \
+            open(os.devnull, "w") as stdout:
+        write_project(tmpdir, **parameters)
+        with chdir(tmpdir), PushFakeTools(), \
+                PushEnvironmentVariable(
+                    "DH_CMAKE_FAKE_MANIFEST_LINES",
+                    str(parameters["manifest_lines"])):
+            arch.dpkg_architecture()
+            for bench_name, func in BENCHMARKS:
+                if benchmarks is None or bench_name in benchmarks:
+                    results[bench_name] = measure(func, repeat, stdout)
+
+    return {"name": name, "parameters": parameters, "results": results}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark dh-cmake on synthetic projects")
+    parser.add_argument("--scenario", action="append",
+                        choices=sorted(SCENARIOS),
+                        help="Scenario to run (default: all)")
+    parser.add_argument("--benchmark", action="append",
+                        choices=[name for name, _ in BENCHMARKS],
+                        help="Benchmark to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to run each benchmark")
+    parser.add_argument("--output", action="store",
+                        help="File to write the results to (default: stdout)")
+    options = parser.parse_args(args)
+
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "deb_build_options": os.environ.get("DEB_BUILD_OPTIONS", ""),
+        "scenarios": [
+            run_scenario(name, options.repeat, options.benchmark)
+            for name in options.scenario or SCENARIOS
+        ],
+    }
+
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+class BenchmarkTestCase(KWTestCaseBase):
+    def test_small(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "results.json")
+            main(["--scenario", "small", "--repeat", "1",
+                  "--output", output])
+            with open(output, "r") as f:
+                report = json.load(f)
+
+        scenario = self.get_single_element(report["scenarios"])
+        self.assertEqual("small", scenario["name"])
+        self.assertEqual({name for name, _ in BENCHMARKS},
+                         set(scenario["results"]))
+        for result in scenario["results"].values():
+            self.assertEqual(1, result["repeat"])
+            self.assertLessEqual(result["min"], result["max"])
+
+    def test_project(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_project(tmpdir, packages=3, components=10, depth=3,
+                          manifest_lines=5, log_lines=5)
+            with chdir(tmpdir):
+                dh = make_dh(self.stdout)
+                dh.read_cpack_metadata()
+                self.assertEqual(["libbench0", "libbench1", "libbench2"],
+                                 dh.get_packages())
+                self.assertEqual({"Component0", "Component3", "Component6",
+                                  "Component9"},
+                                 dh.get_all_cpack_components("libbench0"))
+                self.assertEqual(10, len(
+                    dh.get_all_cpack_components("libbench2")))
+                self.assertEqual({"libbench0", "libbench2"},
+                                 dh.get_package_dependencies("libbench1"))
+
+
+if __name__ == "__main__":
+    main()
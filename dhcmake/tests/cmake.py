@@ -2,10 +2,14 @@
 # BSD 3-Clause license. See top-level LICENSE file or
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
+import asyncio
+import json
 import os.path
+import tempfile
 
-from dhcmake import common, cmake
-from . import KWTestCaseBase, DebianSourcePackageTestCaseBase
+from dhcmake import common, cmake, timing
+from . import KWTestCaseBase, DebianSourcePackageTestCaseBase, \
+    PushEnvironmentVariable
 
 
 class DHCMakeTestCase(DebianSourcePackageTestCaseBase):
@@ -172,6 +176,108 @@ class DHCMakeTestCase(DebianSourcePackageTestCaseBase):
         self.assertFileTreeEqual(self.headers_files | self.namelinks_files,
                                  "debian/libdh-cmake-test-dev")
 
+    def test_dh_cmake_install_parallel(self):
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS", "parallel=4"):
+            self.do_dh_cmake_install([])
+
+        self.assertFileTreeEqual(self.libraries_files,
+                                 "debian/libdh-cmake-test")
+
+        self.assertFileTreeEqual(self.headers_files | self.namelinks_files,
+                                 "debian/libdh-cmake-test-dev")
+
+        expected_contents = "\n".join(self.replace_arch_in_paths([
+            "debian/tmp/usr/include/dh-cmake-test.h",
+            "debian/tmp/usr/include/dh-cmake-test-lib1.h",
+            "debian/tmp/usr/include/dh-cmake-test-lib2.h",
+            "debian/tmp/usr/lib/{arch}/libdh-cmake-test.so",
+            "debian/tmp/usr/lib/{arch}/libdh-cmake-test-lib1.so",
+            "debian/tmp/usr/lib/{arch}/libdh-cmake-test-lib2.so",
+        ])) + "\n"
+        self.assertFileContentsEqual(expected_contents,
+                                     "debian/.debhelper/generated/libdh-cmake-test-dev/"
+                                     "installed-by-dh_cmake_install")
+
+    def test_dh_cmake_install_parallel_error(self):
+        original_job = self.dh._do_cmake_install_job
+        finished = []
+
+        # The first install completes and has its manifest moved aside
+        # before the second one fails with something other than a failed
+        # command
+        async def job(runner, index, **install):
+            if index == 0:
+                result = await original_job(runner, index, **install)
+                finished.append(result)
+                return result
+            while not finished:
+                await asyncio.sleep(0.01)
+            raise OSError("cmake not found")
+
+        self.dh._do_cmake_install_job = job
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS", "parallel=4"), \
+                self.assertRaisesRegex(OSError, "^cmake not found$"):
+            self.do_dh_cmake_install([])
+
+        self.assertIsNotNone(finished[0][2])
+        self.assertFileNotExists(finished[0][2])
+        self.assertEqual([], [name for name in os.listdir(
+            self.dh.get_build_directory()) if ".dh-cmake-" in name])
+
+    def test_dh_cmake_install_profile(self):
+        with PushEnvironmentVariable("DH_CMAKE_PROFILE", "1"), \
+                tempfile.TemporaryFile("w+") as stderr:
+            self.dh.stderr = stderr
+            self.do_dh_cmake_install([])
+            stderr.seek(0)
+            summary = stderr.read()
+
+        with open(timing.PROFILE_LOG, "r") as f:
+            records = [json.loads(line) for line in f]
+
+        tools = [r for r in records if r["kind"] == "tool"]
+        self.assertEqual(["dh_cmake_install"], [r["name"] for r in tools])
+        installs = [r for r in records if r["kind"] == "cmd" and
+                    r["name"].startswith("cmake --install")]
+        self.assertEqual(3, len(installs))
+        for record in records:
+            self.assertEqual("dh_cmake_install", record["tool"])
+            self.assertFalse(record["failed"])
+            self.assertLessEqual(record["wall"], tools[0]["wall"])
+        self.assertRegex(summary, "^dh_cmake_install: [0-9.]+ s wall")
+        self.assertIn("cmake --install", summary)
+
+    def test_dh_cmake_install_incremental(self):
+        installed_by = "debian/.debhelper/generated/libdh-cmake-test-dev/" \
+                       "installed-by-dh_cmake_install"
+        headers = "debian/libdh-cmake-test-dev/usr/include/dh-cmake-test.h"
+
+        def run_install():
+            self.dh = self.DHClass()
+            self.dh.stderr = self.stderr
+            with tempfile.TemporaryFile("w+") as f:
+                self.dh.stdout = f
+                self.dh.install(["--incremental", "-v"])
+                f.seek(0)
+                return [l.split()[-1] for l in f
+                        if l.startswith("\tcmake --install")]
+
+        self.do_dh_cmake_install(["--incremental"])
+        with open(installed_by) as f:
+            log = f.read()
+
+        self.assertEqual([], run_install())
+        self.assertFileContentsEqual(log * 2, installed_by)
+        self.assertFileTreeEqual(self.headers_files | self.namelinks_files,
+                                 "debian/libdh-cmake-test-dev")
+
+        os.utime(headers, ns=(0, 0))
+        self.assertEqual(["Headers"], run_install())
+
+        os.utime("dh-cmake-test.h")
+        self.run_cmd(["make"], cwd=self.dh.get_build_directory())
+        self.assertEqual(["Libraries", "Headers", "Namelinks"], run_install())
+
     def test_dh_cmake_install_package_component(self):
         self.do_dh_cmake_install(["--package", "libdh-cmake-test",
                                   "--component", "Namelinks", "--component",
@@ -4,9 +4,11 @@
 
 #from unittest import skip
 
+import io
 import os
-from dhcmake import common, arch
-from . import DebianSourcePackageTestCaseBase, VolatileNamedTemporaryFile
+from dhcmake import common, arch, timing
+from . import DebianSourcePackageTestCaseBase, VolatileNamedTemporaryFile, \
+    PushEnvironmentVariable
 
 
 class DHCommonTestCase(DebianSourcePackageTestCaseBase):
@@ -200,6 +202,150 @@ class DHCommonTestCase(DebianSourcePackageTestCaseBase):
         self.assertIsNone(self.dh.read_package_file(
             "libdh-cmake-test-doc", "cmake-components"))
 
+    def test_log_install_manifest(self):
+        self.dh.tool_name = "dh_test_log_install_manifest"
+        self.dh.parse_args([])
+        self.dh.options.sourcedir = "debian/tmp"
+
+        with open("install_manifest_Lib.txt", "w") as f:
+            f.write("/usr/lib/libdh-cmake-test.so.1\n"
+                    "/usr/share/doc/dh-cmake-test/README\n")
+
+        self.assertTrue(self.dh.log_install_manifest(
+            "libdh-cmake-test", "install_manifest_Lib.txt"))
+        self.dh.close_installed_logs()
+
+        self.assertFileNotExists("install_manifest_Lib.txt")
+        with open("debian/.debhelper/generated/libdh-cmake-test/"
+                  "installed-by-dh_test_log_install_manifest") as f:
+            self.assertEqual("debian/tmp/usr/lib/libdh-cmake-test.so.1\n"
+                             "debian/tmp/usr/share/doc/dh-cmake-test/README\n",
+                             f.read())
+
+        self.assertFalse(self.dh.log_install_manifest(
+            "libdh-cmake-test", "install_manifest_Lib.txt"))
+
+    def test_entry_point_profile(self):
+        @common.DHEntryPoint("dh_test_profile")
+        def run(dh, args, error=None):
+            dh.parse_args(args)
+            if error:
+                raise error
+
+        stderr = io.StringIO()
+
+        def make_dh():
+            dh = self.DHClass()
+            dh.stderr = stderr
+            return dh
+
+        with PushEnvironmentVariable("DH_CMAKE_PROFILE", "1"):
+            run(make_dh(), ["--no-act"])
+            self.assertFileNotExists(timing.PROFILE_LOG)
+
+            run(make_dh(), [])
+            self.assertFileExists(timing.PROFILE_LOG)
+
+            os.remove(timing.PROFILE_LOG)
+            os.mkdir(timing.PROFILE_LOG)
+            with self.assertRaisesRegex(RuntimeError, "^tool failed$"):
+                run(make_dh(), [], RuntimeError("tool failed"))
+        self.assertIn("dh_test_profile: warning: could not write profile: ",
+                      stderr.getvalue())
+
+    def test_write_substvar(self):
+        self.dh.parse_args(["-v"])
+        self.dh.stdout = io.StringIO()
+
+        with open("debian/libdh-cmake-test.substvars", "w") as f:
+            f.write("misc:Depends=foo\n"
+                    "cpack:Depends=old\n"
+                    "cpack:Depends=older\n"
+                    "shlibs:Depends?=bar")
+
+        self.dh.write_substvar("cpack:Depends", "new", "libdh-cmake-test")
+        self.dh.write_substvar("test:Var", "one", "libdh-cmake-test")
+        self.dh.write_substvar("test:Var", "two", "libdh-cmake-test")
+        self.dh.write_substvar("test:Var", "other", "libdh-cmake-test-dev")
+        self.assertEqual(
+            "\t# Setting cpack:Depends=new in "
+            "debian/libdh-cmake-test.substvars\n",
+            self.dh.stdout.getvalue().splitlines(True)[0])
+        os.chmod("debian/libdh-cmake-test.substvars", 0o664)
+
+        with open("debian/libdh-cmake-test.substvars", "r") as f:
+            self.assertEqual("misc:Depends=foo\n"
+                             "cpack:Depends=old\n"
+                             "cpack:Depends=older\n"
+                             "shlibs:Depends?=bar", f.read())
+        self.assertFileNotExists("debian/libdh-cmake-test-dev.substvars")
+
+        self.dh.flush_substvars()
+
+        with open("debian/libdh-cmake-test.substvars", "r") as f:
+            self.assertEqual("misc:Depends=foo\n"
+                             "cpack:Depends=new\n"
+                             "shlibs:Depends?=bar\n"
+                             "test:Var=two\n", f.read())
+        self.assertEqual(0o664, os.stat(
+            "debian/libdh-cmake-test.substvars").st_mode & 0o777)
+        with open("debian/libdh-cmake-test-dev.substvars", "r") as f:
+            self.assertEqual("test:Var=other\n", f.read())
+
+    def write_counting_package_file(self):
+        with open("debian/libdh-cmake-test-doc.counted", "w") as f:
+            f.write("#!/bin/sh\n"
+                    "echo run >> ../count\n"
+                    "echo Documentation\n")
+        os.chmod("debian/libdh-cmake-test-doc.counted", 0o755)
+
+    def get_package_file_runs(self):
+        try:
+            with open("../count") as f:
+                return len(f.readlines())
+        except FileNotFoundError:
+            return 0
+
+    def test_read_package_file_executable_cached(self):
+        self.dh.parse_args([])
+        self.write_counting_package_file()
+
+        for i in range(3):
+            with self.dh.read_package_file(
+                    "libdh-cmake-test-doc", "counted") as f:
+                self.assertEqual("Documentation\n", f.read())
+        self.assertEqual(1, self.get_package_file_runs())
+
+        with PushEnvironmentVariable("DEB_HOST_ARCH", "armhf"):
+            with self.dh.read_package_file(
+                    "libdh-cmake-test-doc", "counted") as f:
+                self.assertEqual("Documentation\n", f.read())
+        self.assertEqual(2, self.get_package_file_runs())
+
+        os.utime("debian/libdh-cmake-test-doc.counted", ns=(0, 0))
+        with self.dh.read_package_file(
+                "libdh-cmake-test-doc", "counted") as f:
+            self.assertEqual("Documentation\n", f.read())
+        self.assertEqual(3, self.get_package_file_runs())
+
+    def test_read_package_file_executable_disk_cache(self):
+        self.dh.parse_args([])
+        self.write_counting_package_file()
+
+        with PushEnvironmentVariable("DH_CMAKE_PACKAGE_FILE_CACHE", "1"):
+            with self.dh.read_package_file(
+                    "libdh-cmake-test-doc", "counted") as f:
+                self.assertEqual("Documentation\n", f.read())
+            self.assertEqual(1, len(os.listdir(common.PACKAGE_FILE_CACHE)))
+
+            # Simulate the next dh_* command of the build
+            common._package_file_outputs.clear()
+            with self.dh.read_package_file(
+                    "libdh-cmake-test-doc", "counted") as f:
+                self.assertEqual("Documentation\n", f.read())
+
+        self.assertEqual(1, self.get_package_file_runs())
+
     def test_build_directory_default(self):
         self.dh.parse_args([])
 
@@ -243,6 +389,27 @@ class DHCommonTestCase(DebianSourcePackageTestCaseBase):
         self.assertEqual("debian/tmpdir",
                          self.dh.get_tmpdir("libdh-cmake-test-dev"))
 
+    def test_parallel_default(self):
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS", "nocheck"):
+            self.dh.parse_args([])
+
+            self.assertIsNone(common.get_deb_build_parallel())
+            self.assertEqual(1, self.dh.get_parallel())
+
+    def test_parallel(self):
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS",
+                                     "nocheck parallel=8"):
+            self.dh.parse_args([])
+
+            self.assertEqual(8, common.get_deb_build_parallel())
+            self.assertEqual(8, self.dh.get_parallel())
+
+    def test_parallel_max(self):
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS", "parallel=8"):
+            self.dh.parse_args(["--max-parallel=2"])
+
+            self.assertEqual(2, self.dh.get_parallel())
+
     def test_o_flag(self):
         self.dh.parse_args(["-O=-v"])
 
@@ -307,3 +474,10 @@ class DHCommonCompatTestCase(DebianSourcePackageTestCaseBase):
         self.dh.test_command([])
         self.assertEqual(1, self.dh._compat)
         self.assertEqual("dh_common_test_command", self.dh.tool_name)
+
+    def test_arch_cache(self):
+        self.dh.test_command([])
+        self.assertFileExists(common.ARCH_CACHE)
+
+        self.dh.test_command(["--no-act"])
+        self.assertTrue(arch.load_cache(common.ARCH_CACHE))
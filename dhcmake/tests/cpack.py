@@ -3,9 +3,14 @@
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
 import contextlib
+import json
 import os
+import re
+import sys
+import tempfile
 from dhcmake import cpack, arch
-from . import DebianSourcePackageTestCaseBase, KWTestCaseBase
+from . import DebianSourcePackageTestCaseBase, KWTestCaseBase, \
+    PushEnvironmentVariable
 
 from debian import debfile, deb822
 
@@ -83,6 +88,50 @@ class DHCPackTestCase(DebianSourcePackageTestCaseBase):
         self.dh.generate([])
         self.assertFileExists("debian/.cpack/cpack-metadata.json")
 
+    def test_generate_incremental(self):
+        def run_generate(args=[]):
+            self.dh = self.DHClass()
+            self.dh.stderr = self.stderr
+            with tempfile.TemporaryFile("w+") as f:
+                self.dh.stdout = f
+                self.dh.generate(["-v"] + args)
+                f.seek(0)
+                return "\tcpack --config" in f.read()
+
+        self.assertTrue(run_generate())
+        self.assertFalse(run_generate())
+        self.assertTrue(run_generate(["--force"]))
+
+        with open(os.path.join(self.dh.get_build_directory(),
+                               "CPackConfig.cmake"), "a") as f:
+            f.write("set(CPACK_COMPONENTS_GROUPING IGNORE)\n")
+        self.assertTrue(run_generate())
+        self.assertFalse(run_generate())
+
+        with open(os.path.join(self.dh.get_build_directory(),
+                               "lib1/cmake_install.cmake"), "a") as f:
+            f.write("# Changed\n")
+        self.assertTrue(run_generate())
+
+        os.unlink("debian/.cpack/cpack-metadata.json")
+        self.assertTrue(run_generate())
+        self.assertFileExists("debian/.cpack/cpack-metadata.json")
+
+    def test_cpack_config_fingerprint_empty(self):
+        with open("CPackConfig.cmake", "w") as f:
+            f.write("include(\"%s/empty.cmake\")\n" % os.getcwd())
+        with open("empty.cmake", "w"):
+            pass
+
+        fingerprint = self.dh.get_cpack_config_fingerprint(
+            "CPackConfig.cmake", [])
+        self.assertEqual([], fingerprint["args"])
+
+        with open("empty.cmake", "w") as f:
+            f.write("\n")
+        self.assertNotEqual(fingerprint, self.dh.get_cpack_config_fingerprint(
+            "CPackConfig.cmake", []))
+
     def test_get_cpack_components(self):
         with open("debian/libdh-cmake-test-extra-32.cpack-components", "w") \
                 as f:
@@ -142,6 +191,17 @@ class DHCPackTestCase(DebianSourcePackageTestCaseBase):
         self.assertEqual({"Libraries"},
                          self.dh.get_all_cpack_components("libdh-cmake-test"))
 
+    def test_get_cpack_component_projects(self):
+        self.dh.generate([])
+        self.dh.read_cpack_metadata()
+
+        projects = self.dh.get_cpack_component_projects()
+        self.assertEqual({"Libraries", "Headers", "Namelinks"},
+                         set(projects))
+        for component in ("Libraries", "Headers", "Namelinks"):
+            self.assertEqual([self.dh.cpack_metadata.projects[0]],
+                             projects[component])
+
     def test_get_package_dependencies(self):
         self.dh.generate([])
         self.dh.read_cpack_metadata()
@@ -164,6 +224,15 @@ class DHCPackTestCase(DebianSourcePackageTestCaseBase):
             self.assertEqual("cpack:Depends=libdh-cmake-test "
                              "(= ${binary:Version})\n", f.read())
 
+    def test_substvars_rerun(self):
+        self.dh.generate([])
+        self.dh.substvars([])
+        self.dh.substvars([])
+
+        with open("debian/libdh-cmake-test-dev.substvars", "r") as f:
+            self.assertEqual("cpack:Depends=libdh-cmake-test "
+                             "(= ${binary:Version})\n", f.read())
+
     def test_substvars_packages(self):
         self.dh.generate([])
         self.dh.substvars(["--package", "libdh-cmake-test-dev"])
@@ -180,6 +249,28 @@ class DHCPackTestCase(DebianSourcePackageTestCaseBase):
         self.assertFileTreeEqual(self.headers_files | self.namelinks_files,
                                  "debian/libdh-cmake-test-dev")
 
+    def test_install_parallel(self):
+        self.dh.generate([])
+        # Headers is installed into two packages from the same build
+        # directory, so both installs share one install manifest
+        with open("debian/libdh-cmake-test.cpack-components", "a") as f:
+            f.write("Headers\n")
+
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS", "parallel=4"):
+            self.dh.install([])
+
+        self.assertFileTreeEqual(self.libraries_files | self.headers_files,
+                                 "debian/libdh-cmake-test")
+
+        self.assertFileTreeEqual(self.headers_files | self.namelinks_files,
+                                 "debian/libdh-cmake-test-dev")
+
+        for package in ("libdh-cmake-test", "libdh-cmake-test-dev"):
+            with open("debian/.debhelper/generated/%s/"
+                      "installed-by-dh_cpack_install" % package) as f:
+                self.assertIn("debian/tmp/usr/include/dh-cmake-test.h\n",
+                              f.read())
+
     def test_run_debian_rules(self):
         self.run_debian_rules("build", "cpack")
         self.run_debian_rules("install", "cpack")
@@ -210,3 +301,188 @@ class DHCPackTestCase(DebianSourcePackageTestCaseBase):
                     },
                 ],
             ], packages.relations["depends"])
+
+
+class CPackComponentGraphTestCase(KWTestCaseBase):
+    cpack_metadata = {
+        "formatVersionMajor": 1,
+        "formatVersionMinor": 0,
+        "components": {
+            "Libraries": {"dependencies": []},
+            "Plugins": {"dependencies": ["Libraries"]},
+            "Headers": {"dependencies": ["Libraries"]},
+            "Tools": {"dependencies": ["Libraries", "Plugins"]},
+        },
+        "componentGroups": {},
+        "projects": [],
+    }
+
+    def setUp(self):
+        self.graph = cpack.CPackComponentGraph(
+            cpack.CPackMetadata(self.cpack_metadata), {
+                "libfoo": {"Libraries"},
+                "libfoo-plugins": {"Plugins"},
+                "libfoo-dev": {"Headers"},
+                "foo-tools": {"Tools"},
+                "foo-all": {"Libraries", "Plugins"},
+            })
+
+    def test_component_packages(self):
+        self.assertEqual({"libfoo", "foo-all"},
+                         self.graph.component_packages["Libraries"])
+        self.assertEqual({"libfoo-dev"},
+                         self.graph.component_packages["Headers"])
+
+    def test_get_component_dependencies(self):
+        self.assertEqual(set(),
+                         self.graph.get_component_dependencies({"Libraries"}))
+        self.assertEqual({"libfoo", "foo-all"},
+                         self.graph.get_component_dependencies({"Headers"}))
+        self.assertEqual({"libfoo", "libfoo-plugins", "foo-all"},
+                         self.graph.get_component_dependencies({"Tools"}))
+
+
+class CPackMetadataTestCase(KWTestCaseBase):
+    def make_metadata(self):
+        return {
+            "formatVersionMajor": 1,
+            "formatVersionMinor": 0,
+            "buildType": "Release",
+            "stripFiles": True,
+            "components": {
+                "Libraries": {"name": "Libraries", "dependencies": [],
+                              "group": "Runtime"},
+                "Headers": {"name": "Headers", "dependencies": ["Libraries"],
+                            "group": "SDK"},
+            },
+            "componentGroups": {
+                "Runtime": {"name": "Runtime", "components": ["Libraries"],
+                            "subgroups": [], "parentGroup": "SDK"},
+                "SDK": {"name": "SDK", "components": ["Headers"],
+                        "subgroups": ["Runtime"]},
+            },
+            "projects": [
+                {"projectName": "foo", "directory": "/build/foo",
+                 "subDirectory": "/", "component": "ALL",
+                 "components": ["Libraries", "Headers"]},
+            ],
+        }
+
+    def test_model(self):
+        metadata = cpack.CPackMetadata(self.make_metadata())
+
+        self.assertEqual("Release", metadata.build_type)
+        self.assertTrue(metadata.strip_files)
+        self.assertEqual(("Libraries",),
+                         metadata.components["Headers"].dependencies)
+        self.assertEqual("SDK", metadata.components["Headers"].group)
+        self.assertEqual("SDK", metadata.component_groups["Runtime"]
+                         .parent_group)
+        self.assertEqual({"Libraries", "Headers"},
+                         metadata.component_groups["SDK"].all_components)
+        self.assertEqual(["Runtime", "SDK"], metadata.group_order)
+        self.assertEqual("/build/foo", metadata.projects[0].directory)
+        self.assertEqual([metadata.projects[0]],
+                         metadata.component_projects["Headers"])
+        self.assertIs(metadata.projects[0].components[0],
+                      sys.intern("Libraries"))
+
+    def test_optional_fields(self):
+        data = self.make_metadata()
+        del data["buildType"]
+        del data["stripFiles"]
+        metadata = cpack.CPackMetadata(data)
+
+        self.assertIsNone(metadata.build_type)
+        self.assertFalse(metadata.strip_files)
+
+    def test_invalid(self):
+        data = self.make_metadata()
+        data["formatVersionMajor"] = 2
+        with self.assertRaisesRegex(
+                cpack.CPackMetadataError,
+                "Unsupported CPack metadata format version 2"):
+            cpack.CPackMetadata(data)
+
+        data = self.make_metadata()
+        del data["components"]["Headers"]["dependencies"]
+        with self.assertRaisesRegex(
+                cpack.CPackMetadataError,
+                "Missing field dependencies in CPack component Headers"):
+            cpack.CPackMetadata(data)
+
+        data = self.make_metadata()
+        data["projects"][0]["directory"] = None
+        with self.assertRaisesRegex(
+                cpack.CPackMetadataError,
+                "Invalid field directory in CPack project 0"):
+            cpack.CPackMetadata(data)
+
+        data = self.make_metadata()
+        data["componentGroups"]["SDK"]["subgroups"] = ["Missing"]
+        with self.assertRaisesRegex(
+                ValueError, "Invalid CPack component group Missing"):
+            cpack.CPackMetadata(data)
+
+    def test_load(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "cpack-metadata.json")
+            with open(path, "w") as f:
+                f.write("{")
+            with self.assertRaisesRegex(
+                    cpack.CPackMetadataError,
+                    "Invalid CPack metadata in %s" % re.escape(path)):
+                cpack.CPackMetadata.load(path)
+
+            data = self.make_metadata()
+            del data["projects"]
+            with open(path, "w") as f:
+                json.dump(data, f)
+            with self.assertRaisesRegex(
+                    cpack.CPackMetadataError,
+                    "%s: Missing field projects" % re.escape(path)):
+                cpack.CPackMetadata.load(path)
+
+
+class CPackGroupClosuresTestCase(KWTestCaseBase):
+    def test_closures(self):
+        order, closures = cpack.get_cpack_group_closures({
+            "All": {"components": [], "subgroups": ["Runtime", "SDK"]},
+            "SDK": {"components": ["Headers"], "subgroups": ["Runtime"]},
+            "Runtime": {"components": ["Libraries"], "subgroups": []},
+        })
+
+        self.assertEqual({"Libraries"}, closures["Runtime"])
+        self.assertEqual({"Libraries", "Headers"}, closures["SDK"])
+        self.assertEqual({"Libraries", "Headers"}, closures["All"])
+        self.assertEqual(["Runtime", "SDK", "All"], order)
+
+    def test_deep(self):
+        depth = 2000
+        groups = {"G%i" % i: {"components": ["C%i" % i],
+                              "subgroups": ["G%i" % (i + 1)]}
+                  for i in range(depth)}
+        groups["G%i" % depth] = {"components": [], "subgroups": []}
+
+        order, closures = cpack.get_cpack_group_closures(groups)
+
+        self.assertEqual(depth, len(closures["G0"]))
+        self.assertEqual("G0", order[-1])
+
+    def test_cycle(self):
+        with self.assertRaisesRegex(
+                ValueError,
+                "Cycle in CPack component groups: B -> C -> D -> B"):
+            cpack.get_cpack_group_closures({
+                "A": {"components": [], "subgroups": ["B"]},
+                "B": {"components": [], "subgroups": ["C"]},
+                "C": {"components": [], "subgroups": ["D"]},
+                "D": {"components": [], "subgroups": ["B"]},
+            })
+
+    def test_invalid_subgroup(self):
+        with self.assertRaisesRegex(
+                ValueError, "Invalid CPack component group B in group A"):
+            cpack.get_cpack_group_closures({
+                "A": {"components": [], "subgroups": ["B"]},
+            })
@@ -2,59 +2,20 @@
 # BSD 3-Clause license. See top-level LICENSE file or
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
+import argparse
 import http.server
+import json
 import re
 import subprocess
+import tempfile
 import threading
 import urllib.parse
 import xml.etree.ElementTree
 import os
 
 from dhcmake import ctest
-from . import DebianSourcePackageTestCaseBase, KWTestCaseBase
-
-
-class PushEnvironmentVariable:
-    def __init__(self, name, value):
-        self.name = name
-        try:
-            self.old_value = os.environ[name]
-        except KeyError:
-            self.old_value = None
-
-        os.environ[name] = value
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc_value, traceback):
-        if self.old_value is None:
-            del os.environ[self.name]
-        else:
-            os.environ[self.name] = self.old_value
-
-
-class PushEnvironmentVariableTestCase(KWTestCaseBase):
-    varname = "DH_CMAKE_TEST_VARIABLE_DO_NOT_SET"
-
-    def test_create_new(self):
-        try:
-            del os.environ[self.varname]
-        except KeyError:
-            pass
-
-        with PushEnvironmentVariable(self.varname, "value"):
-            self.assertEqual("value", os.environ[self.varname])
-
-        self.assertNotIn(self.varname, os.environ)
-
-    def test_change(self):
-        os.environ[self.varname] = "old"
-
-        with PushEnvironmentVariable(self.varname, "new"):
-            self.assertEqual("new", os.environ[self.varname])
-
-        self.assertEqual("old", os.environ[self.varname])
+from . import DebianSourcePackageTestCaseBase, PushEnvironmentVariable, \
+    PushFakeTools
 
 
 class MockCDashServerHandler(http.server.BaseHTTPRequestHandler):
@@ -69,6 +30,11 @@ class MockCDashServerHandler(http.server.BaseHTTPRequestHandler):
             self.send_error(404)
             return
 
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_error(503)
+            return
+
         self.send_response(100)
         self.end_headers()
         self.flush_headers()
@@ -89,6 +55,7 @@ class MockCDashServer(http.server.HTTPServer):
         super().__init__(server_address, MockCDashServerHandler)
 
         self.submitted_files = set()
+        self.failures = 0
 
 
 class DHCTestTestCase(DebianSourcePackageTestCaseBase):
@@ -150,6 +117,49 @@ class DHCTestTestCase(DebianSourcePackageTestCaseBase):
             with self.assertRaisesRegex(ValueError, "Unclosed backslash"):
                 ctest.get_deb_ctest_option("opt1")
 
+    def test_deb_ctest_options(self):
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS", ""):
+            options = self.dh.deb_ctest_options
+            self.assertIsNone(options.model)
+            self.assertFalse(options.submit)
+            self.assertIsNone(options.parallel)
+
+        with PushEnvironmentVariable(
+                "DEB_CTEST_OPTIONS",
+                "model=Experimental submit site=\"deb test\" parallel=4 "
+                "testload=0"):
+            options = self.dh.deb_ctest_options
+            self.assertEqual("Experimental", options.model)
+            self.assertTrue(options.submit)
+            self.assertFalse(options.update)
+            self.assertEqual("deb test", options.site)
+            self.assertIsNone(options.track)
+            self.assertEqual(4, options.parallel)
+            self.assertEqual(0, options.testload)
+            # Parsed once for each value of DEB_CTEST_OPTIONS
+            self.assertIs(options, self.dh.deb_ctest_options)
+
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "submit=1 update=0 outbox="):
+            options = self.dh.deb_ctest_options
+            self.assertIs(True, options.submit)
+            self.assertIs(True, options.update)
+            self.assertIs(False, options.outbox)
+            self.assertIs(False, options.catchfailed)
+
+        for value, message in [
+            ("model=Experimental sumbit",
+             "^Unknown option sumbit in DEB_CTEST_OPTIONS$"),
+            ("model", "^Option model in DEB_CTEST_OPTIONS requires a value$"),
+            ("parallel=0", "^Invalid parallel level in DEB_CTEST_OPTIONS$"),
+            ("testload", "^Invalid test load in DEB_CTEST_OPTIONS$"),
+            ("site=\"a", "^Unclosed quote$"),
+        ]:
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS", value):
+                with self.assertRaisesRegex(ctest.DebCTestOptionsError,
+                                            message):
+                    self.dh.deb_ctest_options
+
     def test_clean(self):
         os.makedirs("debian/.ctest/Testing")
         with open("debian/.ctest/Testing/TAG", "w") as f:
@@ -900,6 +910,254 @@ class DHCTestTestCase(DebianSourcePackageTestCaseBase):
 
             self.assertFilesSubmittedEqual({"Configure", "Build", "Test"})
 
+    def get_test_cmd(self, args):
+        dh = ctest.DHCTest()
+        with tempfile.TemporaryFile("w+") as f:
+            dh.stdout = f
+            dh.test(["-v", "--no-act", *args])
+            f.seek(0)
+            return self.get_single_element(f.read().splitlines())
+
+    def test_test_parallel(self):
+        with PushEnvironmentVariable("DEB_BUILD_OPTIONS", "parallel=4"):
+            self.assertRegex(self.get_test_cmd([]),
+                             "&& ctest -VV -j 4$")
+            self.assertRegex(self.get_test_cmd(["--max-parallel=2"]),
+                             "&& ctest -VV -j 2$")
+            self.assertRegex(self.get_test_cmd(["--test-load=3"]),
+                             "&& ctest -VV -j 4 --test-load 3$")
+
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                         "parallel=8 testload=6"):
+                self.assertRegex(self.get_test_cmd([]),
+                                 "&& ctest -VV -j 8 --test-load 6$")
+                self.assertRegex(self.get_test_cmd(["--test-load=3"]),
+                                 "&& ctest -VV -j 8 --test-load 3$")
+
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS", "parallel=1"):
+                self.assertRegex(self.get_test_cmd([]), "&& ctest -VV$")
+
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                         "model=Experimental"):
+                cmd = self.get_test_cmd(["--test-load=3"])
+                self.assertIn(" -DDH_CTEST_PARALLEL_LEVEL:STRING=4 ", cmd)
+                self.assertRegex(cmd, " -DDH_CTEST_TEST_LOAD:STRING=3( |$)")
+
+        self.assertRegex(self.get_test_cmd([]), "&& ctest -VV$")
+
+    def test_test_parallel_invalid(self):
+        for options in ("parallel=0", "parallel=x", "parallel",
+                        "testload=x"):
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS", options):
+                with self.assertRaises(ValueError):
+                    ctest.DHCTest().test(["--no-act"])
+
+    def test_parse_test_result(self):
+        self.assertEqual({
+            "index": 3,
+            "name": "a test",
+            "status": "Failed",
+            "duration": 0.25,
+        }, ctest.parse_test_result(
+            " 1/12 Test  #3: a test ........***Failed    0.25 sec\n"))
+        self.assertEqual({
+            "index": 5,
+            "name": "disabled",
+            "status": "Not Run (Disabled)",
+            "duration": 0.0,
+        }, ctest.parse_test_result(
+            "4/6 Test #5: disabled ....***Not Run (Disabled)   0.00 sec"))
+        self.assertEqual("Passed", ctest.parse_test_result(
+            "2/6 Test #1: pass ...   Passed    1.00 sec")["status"])
+        # Output of a test
+        self.assertIsNone(ctest.parse_test_result(
+            "4: 1/6 Test #1: pass ...   Passed    1.00 sec"))
+        self.assertIsNone(ctest.parse_test_result("      Start  1: pass"))
+
+    def test_test_results(self):
+        os.makedirs("build")
+        with open("build/fake-ctest-output.txt", "w") as f:
+            f.write("      Start 1: pass\n"
+                    "1: Test command: /usr/bin/true\n"
+                    "1/2 Test #1: pass .............   Passed    0.50 sec\n"
+                    "      Start 2: fail\n"
+                    "2/2 Test #2: fail .............***Failed    1.25 sec\n")
+        with open("build/fake-ctest-tests.json", "w") as f:
+            json.dump({"kind": "ctestInfo", "tests": [
+                {"name": "pass", "properties": [
+                    {"name": "LABELS", "value": ["fast", "unit"]},
+                ]},
+                {"name": "fail"},
+            ]}, f)
+
+        with PushFakeTools(), tempfile.TemporaryFile("w+") as f:
+            self.dh.stdout = f
+            self.dh.test(["-B", "build"])
+            f.seek(0)
+            self.assertIn("2/2 Test #2: fail", f.read())
+
+        with open("debian/.ctest/" + ctest.TEST_RESULTS, "r") as f:
+            results = [json.loads(line) for line in f]
+        self.assertEqual([
+            {"index": 1, "name": "pass", "status": "Passed",
+             "duration": 0.5, "labels": ["fast", "unit"]},
+            {"index": 2, "name": "fail", "status": "Failed",
+             "duration": 1.25, "labels": []},
+        ], results)
+
+    def test_test_cost_data(self):
+        cost_data = "build/Testing/Temporary/CTestCostData.txt"
+        os.makedirs("build")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = os.path.join(tmpdir, "cache/dh-cmake-test.txt")
+
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                         "costdata=" + os.path.dirname(cache)), \
+                    PushFakeTools():
+                # Nothing to restore or save yet
+                self.dh.test(["-B", "build"])
+                self.assertFileNotExists(cost_data)
+                self.assertFileNotExists(cache)
+
+                os.makedirs(os.path.dirname(cache))
+                with open(os.path.join(tmpdir, "cache", "other.txt"),
+                          "w") as f:
+                    f.write("other 1 1\n")
+                with open(cache, "w") as f:
+                    f.write("slow 1 10\nfast 1 0.1\n---\n")
+                self.dh.test(["-B", "build"])
+                with open(cost_data, "r") as f:
+                    self.assertEqual("slow 1 10\nfast 1 0.1\n---\n", f.read())
+
+                # The cost data of the build tree is newer than the cache
+                with open(cost_data, "w") as f:
+                    f.write("slow 2 12\nfast 2 0.1\n---\nslow\n")
+                self.dh.test(["-B", "build"])
+                with open(cache, "r") as f:
+                    self.assertEqual("slow 2 12\nfast 2 0.1\n---\nslow\n",
+                                     f.read())
+                self.assertEqual(
+                    ["dh-cmake-test.txt", "other.txt"],
+                    sorted(os.listdir(os.path.dirname(cache))))
+
+    def test_test_experimental_parallel(self):
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental parallel=4"):
+            self.dh.start([])
+            self.dh.configure([])
+            self.dh.build([])
+            self.dh.test(["-O--test-load=64"])
+            date = self.get_testing_tag_date()
+
+            with open(os.path.join("debian/.ctest/Testing", date, "Test.xml"),
+                      "r") as f:
+                tree = xml.etree.ElementTree.fromstring(f.read())
+
+            test_true = self.get_single_element(tree.findall(
+                "Testing/Test[Name='TestTrue']"))
+            self.assertEqual("passed", test_true.get("Status"))
+
+    def get_steps_cmds(self, steps, args=[]):
+        dh = ctest.DHCTest()
+        with tempfile.TemporaryFile("w+") as f:
+            dh.stdout = f
+            dh.steps(steps, ["-v", "--no-act", *args])
+            f.seek(0)
+            return f.read().splitlines()
+
+    def test_parse_steps(self):
+        self.assertEqual(["start", "configure", "test"],
+                         ctest.parse_steps("start,ctest_configure, dh_ctest_test"))
+
+        with self.assertRaisesRegex(ValueError, "Unknown step: clean"):
+            ctest.parse_steps("start,clean")
+
+    def test_steps_none(self):
+        cmds = self.get_steps_cmds(
+            ["start", "update", "configure", "build", "test", "submit"])
+
+        self.assertEqual(3, len(cmds))
+        self.assertEqual("\tdh_auto_configure -v --no-act", cmds[0])
+        self.assertEqual("\tdh_auto_build -v --no-act", cmds[1])
+        self.assertRegex(cmds[2], "&& ctest -VV$")
+
+    def test_steps_options(self):
+        cmds = self.get_steps_cmds(["configure", "test"],
+                                   ["--test-load", "3", "--builddirectory",
+                                    "build"])
+
+        self.assertEqual(2, len(cmds))
+        self.assertEqual(
+            "\tdh_auto_configure -v --no-act --builddirectory build", cmds[0])
+        self.assertRegex(cmds[1], "&& ctest -VV --test-load 3$")
+
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental submit"):
+            cmd = self.get_single_element(self.get_steps_cmds(
+                ["configure", "submit"],
+                ["--parts", "Configure", "Notes", "--ctest-testing-dir",
+                 "debian/.ctest-other"]))
+
+        self.assertIn(' "-DDH_CTEST_RUN_CMD_configure:STRING='
+                      'dh_auto_configure -v --no-act" ', cmd)
+        self.assertIn(" -DDH_CTEST_SUBMIT_PARTS:STRING=Configure;Notes", cmd)
+        self.assertIn("debian/.ctest-other", cmd)
+
+        with self.assertRaises(SystemExit):
+            self.get_steps_cmds(["configure"], ["--parts", "Configure"])
+
+    def test_steps_experimental(self):
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental parallel=2"):
+            cmd = self.get_single_element(self.get_steps_cmds(
+                ["start", "update", "configure", "build", "test", "submit"]))
+
+        self.assertIn(" -DDH_CTEST_STEPS:STRING=start;configure;build;test ",
+                      cmd)
+        self.assertIn(' "-DDH_CTEST_RUN_CMD_configure:STRING='
+                      'dh_auto_configure -v --no-act" ', cmd)
+        self.assertIn(' "-DDH_CTEST_RUN_CMD_build:STRING='
+                      'dh_auto_build -v --no-act" ', cmd)
+        self.assertIn(" -DDH_CTEST_PARALLEL_LEVEL:STRING=2", cmd)
+        self.assertNotIn("DH_CTEST_STEP_SUBMIT", cmd)
+
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental submit update"):
+            cmd = self.get_single_element(self.get_steps_cmds(
+                ["start", "update", "submit"]))
+
+        self.assertRegex(cmd, " -DDH_CTEST_STEPS:STRING=start;update;submit$")
+        self.assertIn(" -DDH_CTEST_STEP_SUBMIT:BOOL=ON ", cmd)
+
+    def test_steps_experimental_submit(self):
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental submit"):
+            self.dh.steps(["start", "update", "configure", "build", "test"],
+                          [])
+            date = self.get_testing_tag_date()
+
+            with open(os.path.join("debian/.ctest/Testing", date, "Test.xml"),
+                      "r") as f:
+                tree = xml.etree.ElementTree.fromstring(f.read())
+
+            test_true = self.get_single_element(tree.findall(
+                "Testing/Test[Name='TestTrue']"))
+            self.assertEqual("passed", test_true.get("Status"))
+
+            self.assertFilesSubmittedEqual({"Configure", "Build", "Test"})
+
+    def test_submit_arg_parser(self):
+        args = ["--ctest-testing-dir", "debian/ctest", "--ctest-build",
+                "deb", "--ctest-build-suffix", "_arm"]
+        for make_arg_parser in (self.dh.make_arg_parser,
+                                self.dh.submit_make_arg_parser):
+            parser = argparse.ArgumentParser()
+            make_arg_parser(parser)
+            options = parser.parse_args(args)
+            self.assertEqual("debian/ctest", options.ctest_testing_dir)
+            self.assertEqual("deb", options.ctest_build)
+            self.assertEqual("_arm", options.ctest_build_suffix)
+
     def test_submit_none(self):
         self.dh.start([])
         self.dh.configure(["-O--no-submit"])
@@ -943,6 +1201,102 @@ class DHCTestTestCase(DebianSourcePackageTestCaseBase):
 
             self.assertFilesSubmittedEqual({"Configure", "Build"})
 
+    def init_git_repository(self):
+        self.run_cmd(["git", "init", "."])
+        self.run_cmd(["git", "add", "."])
+        self.run_cmd(["git", "commit", "-m", "Initial commit"], env={
+            "GIT_AUTHOR_NAME": "Kitware Robot",
+            "GIT_AUTHOR_EMAIL": "kwrobot@kitware.com",
+            "GIT_COMMITTER_NAME": "Kitware Robot",
+            "GIT_COMMITTER_EMAIL": "kwrobot@kitware.com",
+        })
+
+    def test_submit_experimental_outbox(self):
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental update submit "
+                                     "outbox"):
+            self.init_git_repository()
+            self.dh.start([])
+            self.dh.update([])
+
+            self.assertFilesSubmittedEqual(set())
+            self.assertFileExists("debian/.ctest/outbox/Update.xml")
+
+            self.dh.submit([])
+
+            self.assertFilesSubmittedEqual({"Update"})
+            self.assertEqual([], os.listdir("debian/.ctest/outbox"))
+
+    def test_submit_experimental_outbox_retry(self):
+        old_delay = ctest.SUBMIT_RETRY_DELAY
+        ctest.SUBMIT_RETRY_DELAY = 0
+        try:
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                         "model=Experimental update submit "
+                                         "outbox"):
+                self.init_git_repository()
+                self.dh.start([])
+                self.dh.update([])
+
+                self.cdash_server.failures = ctest.SUBMIT_ATTEMPTS - 1
+                self.dh.submit([])
+
+                self.assertEqual(0, self.cdash_server.failures)
+                self.assertFilesSubmittedEqual({"Update"})
+                self.assertEqual([], os.listdir("debian/.ctest/outbox"))
+        finally:
+            ctest.SUBMIT_RETRY_DELAY = old_delay
+
+    def test_submit_experimental_outbox_retry_exhausted(self):
+        old_delay = ctest.SUBMIT_RETRY_DELAY
+        ctest.SUBMIT_RETRY_DELAY = 0
+        try:
+            with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                         "model=Experimental update submit "
+                                         "outbox"):
+                self.init_git_repository()
+                self.dh.start([])
+                self.dh.update([])
+
+                self.cdash_server.failures = ctest.SUBMIT_ATTEMPTS
+                with tempfile.TemporaryFile("w+") as f:
+                    self.dh.stderr = f
+                    self.dh.submit([])
+                    self.dh.stderr = self.stderr
+                    f.seek(0)
+                    self.assertIn("dh_ctest_submit: warning: could not "
+                                  "submit to CDash after 3 attempts, leaving "
+                                  "1 file in debian/.ctest/outbox",
+                                  f.read())
+
+                self.assertEqual(0, self.cdash_server.failures)
+                self.assertFilesSubmittedEqual(set())
+                self.assertFileExists("debian/.ctest/outbox/Update.xml")
+
+                self.dh.submit([])
+
+                self.assertFilesSubmittedEqual({"Update"})
+                self.assertEqual([], os.listdir("debian/.ctest/outbox"))
+        finally:
+            ctest.SUBMIT_RETRY_DELAY = old_delay
+
+    def test_submit_experimental_outbox_steps(self):
+        with PushEnvironmentVariable("DEB_CTEST_OPTIONS",
+                                     "model=Experimental submit outbox"):
+            self.dh.start([])
+            self.dh.configure([])
+            self.dh.build([])
+            self.dh.test([])
+
+            self.assertFilesSubmittedEqual(set())
+            for part in ("Configure", "Build", "Test"):
+                self.assertFileExists(
+                    os.path.join("debian/.ctest/outbox", part + ".xml"))
+
+            self.dh.submit([])
+
+            self.assertFilesSubmittedEqual({"Configure", "Build", "Test"})
+
     def test_run_debian_rules_none(self):
         self.run_debian_rules("build", "ctest")
 
@@ -3,6 +3,8 @@
 # https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
 
 import os.path
+import shutil
+import tempfile
 
 from dhcmake import deb822
 from . import KWTestCaseBase
@@ -44,3 +46,27 @@ class Deb822TestCase(KWTestCaseBase):
         package = packages[5]
         self.assertEqual("libdh-cmake-test-extra-both", package["package"])
         self.assertEqual(["armhf", "arm64"], package.architecture)
+
+    def test_control_file_cache(self):
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        test_data_dir = os.path.join(test_dir, "data")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            control = os.path.join(tmp_dir, "control")
+            shutil.copy(os.path.join(test_data_dir,
+                                     "debian_pkg/debian/control"), control)
+
+            source, packages = deb822.read_control_file(control)
+            self.assertIsInstance(source, deb822.ControlSource)
+            self.assertIsInstance(packages[0], deb822.ControlPackage)
+            self.assertEqual(6, len(packages))
+
+            self.assertIs(source, deb822.read_control_file(control)[0])
+
+            with open(control, "a") as f:
+                f.write("\nPackage: libdh-cmake-test-extra\n"
+                        "Architecture: any\n")
+
+            source, packages = deb822.read_control_file(control)
+            self.assertEqual(7, len(packages))
+            self.assertEqual("libdh-cmake-test-extra", packages[6]["package"])
@@ -0,0 +1,44 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import os
+import tempfile
+
+from dhcmake import fileutil
+from . import KWTestCaseBase
+
+
+class FileUtilTestCase(KWTestCaseBase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.old_cwd = os.getcwd()
+        os.chdir(self.tmp_dir.name)
+
+    def tearDown(self):
+        os.chdir(self.old_cwd)
+        self.tmp_dir.cleanup()
+
+    def test_atomic_write(self):
+        with open("file.txt", "w") as f:
+            f.write("old\n")
+
+        with self.assertRaises(RuntimeError):
+            with fileutil.atomic_write("file.txt") as f:
+                f.write("partial\n")
+                raise RuntimeError
+        with open("file.txt") as f:
+            self.assertEqual("old\n", f.read())
+
+        with fileutil.atomic_write("file.txt", prefix=".file.") as f:
+            f.write("new\n")
+        with open("file.txt") as f:
+            self.assertEqual("new\n", f.read())
+        self.assertEqual(0o644, os.stat("file.txt").st_mode & 0o777)
+        self.assertEqual([], [name for name in os.listdir(".")
+                              if name.startswith(".file.")])
+
+        os.chmod("file.txt", 0o600)
+        with fileutil.atomic_write("file.txt") as f:
+            f.write("newer\n")
+        self.assertEqual(0o600, os.stat("file.txt").st_mode & 0o777)
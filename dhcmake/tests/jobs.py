@@ -0,0 +1,88 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import os
+import subprocess
+import tempfile
+import time
+
+from dhcmake import jobs
+from . import KWTestCaseBase
+
+
+class JobRunnerTestCase(KWTestCaseBase):
+    # Marks the job as started and running, records how many jobs are
+    # running, and waits up to 10 seconds for the peer job, if any, to start
+    JOB_SCRIPT = """
+touch "started/$1" "running/$1"
+ls running | wc -l > "concurrent-$1"
+i=0
+while [ -n "$2" ] && [ ! -e "started/$2" ]; do
+    i=$((i + 1))
+    [ $i -gt 200 ] && exit 1
+    sleep 0.05
+done
+rm "running/$1"
+echo "$1"
+"""
+
+    def test_run_chains(self):
+        runner = jobs.JobRunner(2)
+        events = []
+
+        def make_job(name, peer=""):
+            async def job():
+                events.append("start " + name)
+                returncode, stdout, stderr = await runner.run_cmd(
+                    ["sh", "-c", self.JOB_SCRIPT, "sh", name, peer],
+                    cwd=tmpdir)
+                self.assertEqual(0, returncode,
+                                 msg="%s never ran alongside %s" %
+                                 (name, peer))
+                events.append("end " + stdout.decode().strip())
+            return job
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.mkdir(os.path.join(tmpdir, "started"))
+            os.mkdir(os.path.join(tmpdir, "running"))
+            # a1 and b1 each wait for the other, so they must overlap
+            runner.run_chains([
+                [make_job("a1", "b1"), make_job("a2")],
+                [make_job("b1", "a1")],
+                [make_job("c1")],
+            ])
+
+            concurrent = {}
+            for name in ("a1", "a2", "b1", "c1"):
+                with open(os.path.join(tmpdir, "concurrent-" + name)) as f:
+                    concurrent[name] = int(f.read())
+
+        # Jobs in a chain run in order
+        self.assertLess(events.index("end a1"), events.index("start a2"))
+        self.assertEqual(8, len(events))
+        # Only two commands run at once
+        self.assertLessEqual(max(concurrent.values()), 2)
+
+    def test_fail_fast(self):
+        runner = jobs.JobRunner(4)
+        finished = []
+
+        def make_job(name, args):
+            async def job():
+                returncode, stdout, stderr = await runner.run_cmd(args)
+                finished.append(name)
+                if returncode:
+                    raise subprocess.CalledProcessError(returncode, args)
+            return job
+
+        start = time.monotonic()
+        with self.assertRaises(subprocess.CalledProcessError):
+            runner.run_chains([
+                [make_job("slow", ["sleep", "10"])],
+                [make_job("fail", ["sh", "-c", "sleep 0.2; exit 3"]),
+                 make_job("after", ["true"])],
+            ])
+
+        self.assertEqual(["fail"], finished)
+        self.assertLess(time.monotonic() - start, 5)
@@ -0,0 +1,82 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import os
+
+from dhcmake import cpack, multi
+from . import DebianSourcePackageTestCaseBase, KWTestCaseBase
+
+
+class MultiTestCase(DebianSourcePackageTestCaseBase):
+    DHClass = cpack.DHCPack
+
+    def test_parse_steps(self):
+        self.assertEqual(
+            ["cpack_generate", "cpack_substvars", "cpack_install"],
+            multi.parse_steps(
+                "cpack_generate,dh_cpack_substvars, cpack_install"))
+
+        with self.assertRaisesRegex(ValueError, "Unknown step: cpack_bogus"):
+            multi.parse_steps("cpack_generate,cpack_bogus")
+
+    def test_group_steps(self):
+        self.assertEqual([
+            ("ctest_clean", None),
+            ("ctest_steps", ["start", "configure", "build"]),
+            ("cmake_install", None),
+            ("ctest_test", None),
+        ], multi.group_steps([
+            "ctest_clean", "ctest_start", "ctest_configure", "ctest_build",
+            "cmake_install", "ctest_test",
+        ]))
+
+    def test_check_args(self):
+        multi.check_args(["-v", "--no-act", "-pdh-cmake-test",
+                          "--builddirectory", "build", "-O--test-load=3"])
+
+        with self.assertRaisesRegex(
+                ValueError, "Not accepted by every step: --test-load 3 "):
+            multi.check_args(["-v", "--test-load", "3"])
+        with self.assertRaisesRegex(
+                ValueError, "Not accepted by every step: --force "):
+            multi.run_steps(["cpack_generate", "ctest_test"], ["--force"],
+                            stdout=self.stdout, stderr=self.stderr)
+        self.assertFalse(os.path.exists("debian/.cpack"))
+
+    def test_run_steps_cpack(self):
+        self.dh.parse_args([])
+        os.mkdir(self.dh.get_build_directory())
+
+        self.run_cmd(
+            [
+                "cmake", "-G", "Unix Makefiles", "-DCMAKE_INSTALL_PREFIX=/usr",
+                self.src_dir,
+            ], cwd=self.dh.get_build_directory())
+        self.run_cmd(["make"], cwd=self.dh.get_build_directory())
+
+        multi.run_steps(
+            multi.parse_steps("cpack_generate,cpack_substvars,cpack_install"),
+            [], stdout=self.stdout, stderr=self.stderr)
+
+        with open("debian/libdh-cmake-test-dev.substvars", "r") as f:
+            self.assertEqual("cpack:Depends=libdh-cmake-test "
+                             "(= ${binary:Version})\n", f.read())
+
+        self.assertFileExists("debian/.debhelper/generated/libdh-cmake-test/"
+                              "installed-by-dh_cpack_install")
+        self.assertFileExists("debian/.debhelper/generated/"
+                              "libdh-cmake-test-dev/"
+                              "installed-by-dh_cpack_install")
+        self.assertFileTreeEqual(set(KWTestCaseBase.replace_arch_in_paths({
+            "usr",
+            "usr/include",
+            "usr/include/dh-cmake-test.h",
+            "usr/include/dh-cmake-test-lib1.h",
+            "usr/include/dh-cmake-test-lib2.h",
+            "usr/lib",
+            "usr/lib/{arch}",
+            "usr/lib/{arch}/libdh-cmake-test.so",
+            "usr/lib/{arch}/libdh-cmake-test-lib1.so",
+            "usr/lib/{arch}/libdh-cmake-test-lib2.so",
+        })), "debian/libdh-cmake-test-dev")
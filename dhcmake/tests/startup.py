@@ -0,0 +1,57 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import os.path
+import re
+import subprocess
+import sys
+
+from . import KWTestCaseBase
+
+
+class StartupTestCase(KWTestCaseBase):
+    # Modules which are too expensive to import when a dh_* command starts
+    slow_modules = {
+        "pkg_resources",
+        "debian.deb822",
+        "asyncio",
+        "concurrent.futures",
+        "tempfile",
+    }
+
+    @classmethod
+    def import_times(cls, code):
+        test_dir = os.path.dirname(os.path.abspath(__file__))
+        root_dir = os.path.dirname(os.path.dirname(test_dir))
+        env = os.environ.copy()
+        env["PYTHONPATH"] = root_dir
+
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                              stderr=subprocess.PIPE, env=env, check=True)
+
+        times = {}
+        for line in proc.stderr.decode().splitlines():
+            match = re.search(
+                "^import time:\\s*([0-9]+) \\|\\s*([0-9]+) \\| ( *)(.*)$",
+                line)
+            if match:
+                times[match.group(4)] = int(match.group(2))
+        return times
+
+    def check_startup(self, module, entry_point):
+        times = self.import_times(
+            "from dhcmake.%s import %s" % (module, entry_point))
+        print("dhcmake.%s: %i us" % (module, times["dhcmake." + module]),
+              file=self.stdout)
+        self.assertEqual(set(), self.slow_modules & set(times),
+                         msg="Slow modules imported by dhcmake.%s" % module)
+
+    def test_cmake(self):
+        self.check_startup("cmake", "install")
+
+    def test_cpack(self):
+        self.check_startup("cpack", "install")
+
+    def test_ctest(self):
+        self.check_startup("ctest", "test")
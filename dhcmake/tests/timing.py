@@ -0,0 +1,61 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import io
+import json
+import os.path
+import subprocess
+import tempfile
+
+from dhcmake import timing
+from . import KWTestCaseBase, PushEnvironmentVariable
+
+
+class TimingTestCase(KWTestCaseBase):
+    def test_disabled(self):
+        with PushEnvironmentVariable("DH_CMAKE_PROFILE", "0"):
+            self.assertIsNone(timing.start("dh_test"))
+            with timing.phase("phase", "nothing"):
+                pass
+            self.assertIsNone(timing.stop())
+
+    def test_profiler(self):
+        with PushEnvironmentVariable("DH_CMAKE_PROFILE", "1"):
+            profiler = timing.start("dh_test")
+        try:
+            with timing.phase("tool", "dh_test"):
+                with timing.phase("cmd", "sleep 0.1", extra=1):
+                    subprocess.run(["sleep", "0.1"], check=True)
+                with self.assertRaises(ValueError):
+                    with timing.phase("phase", "broken"):
+                        raise ValueError
+        finally:
+            self.assertIs(profiler, timing.stop())
+
+        cmd, broken, tool = profiler.records
+        self.assertEqual("cmd", cmd["kind"])
+        self.assertEqual("sleep 0.1", cmd["name"])
+        self.assertEqual(1, cmd["extra"])
+        self.assertGreaterEqual(cmd["wall"], 0.1)
+        self.assertFalse(cmd["failed"])
+        self.assertTrue(broken["failed"])
+        self.assertEqual("tool", tool["kind"])
+        self.assertGreaterEqual(tool["wall"], cmd["wall"])
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "debian/.debhelper/profile.jsonl")
+            profiler.write(path)
+            profiler.write(path)
+            with open(path, "r") as f:
+                records = [json.loads(line) for line in f]
+        self.assertEqual(profiler.records * 2, records)
+
+        summary = io.StringIO()
+        profiler.print_summary(summary)
+        lines = summary.getvalue().splitlines()
+        self.assertRegex(lines[0], "^dh_test: [0-9.]+ s wall")
+        self.assertRegex(lines[1], "^  cmd +1 x")
+        self.assertRegex(lines[2], "^  phase +1 x")
+        self.assertEqual("  slowest:", lines[3])
+        self.assertRegex(lines[4], "cmd +sleep 0.1$")
@@ -0,0 +1,110 @@
+# This file is part of dh-cmake, and is distributed under the OSI-approved
+# BSD 3-Clause license. See top-level LICENSE file or
+# https://gitlab.kitware.com/debian/dh-cmake/blob/master/LICENSE for details.
+
+import contextlib
+import json
+import os
+import time
+
+
+PROFILE_LOG = "debian/.debhelper/dh-cmake-profile.jsonl"
+
+
+def is_enabled():
+    return os.environ.get("DH_CMAKE_PROFILE") == "1"
+
+
+def _cpu_times():
+    times = os.times()
+    return times.user + times.system, \
+        times.children_user + times.children_system
+
+
+class Profiler:
+    def __init__(self, tool_name):
+        self.tool_name = tool_name
+        self.records = []
+
+    @contextlib.contextmanager
+    def phase(self, kind, name, **info):
+        # CPU time is split between this process and the child processes
+        # that were reaped while the phase ran. Phases which overlap, like
+        # parallel installs, will see each other's CPU time.
+        start_wall = time.perf_counter()
+        start_cpu, start_children_cpu = _cpu_times()
+        failed = True
+        try:
+            yield
+            failed = False
+        finally:
+            cpu, children_cpu = _cpu_times()
+            record = {
+                "tool": self.tool_name,
+                "kind": kind,
+                "name": name,
+                "wall": time.perf_counter() - start_wall,
+                "cpu": cpu - start_cpu,
+                "children_cpu": children_cpu - start_children_cpu,
+                "failed": failed,
+            }
+            record.update(info)
+            self.records.append(record)
+
+    def write(self, path=PROFILE_LOG):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            for record in self.records:
+                f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def print_summary(self, file, limit=10):
+        totals = {}
+        for record in self.records:
+            if record["kind"] == "tool":
+                continue
+            total = totals.setdefault(record["kind"], [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += record["wall"]
+            total[2] += record["cpu"] + record["children_cpu"]
+
+        for record in self.records:
+            if record["kind"] == "tool":
+                print("%s: %.3f s wall, %.3f s CPU" % (
+                    self.tool_name, record["wall"],
+                    record["cpu"] + record["children_cpu"]), file=file)
+        for kind, (count, wall, cpu) in sorted(totals.items()):
+            print("  %-8s %5i x %9.3f s wall %9.3f s CPU" %
+                  (kind, count, wall, cpu), file=file)
+
+        slowest = sorted((r for r in self.records if r["kind"] != "tool"),
+                         key=lambda r: r["wall"], reverse=True)[:limit]
+        if slowest:
+            print("  slowest:", file=file)
+        for record in slowest:
+            print("  %9.3f s  %-8s %s" % (record["wall"], record["kind"],
+                                          record["name"]), file=file)
+
+
+_profiler = None
+
+
+def start(tool_name):
+    global _profiler
+    if is_enabled():
+        _profiler = Profiler(tool_name)
+    else:
+        _profiler = None
+    return _profiler
+
+
+def stop():
+    global _profiler
+    profiler = _profiler
+    _profiler = None
+    return profiler
+
+
+def phase(kind, name, **info):
+    if _profiler is None:
+        return contextlib.nullcontext()
+    return _profiler.phase(kind, name, **info)
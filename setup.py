@@ -48,9 +48,11 @@ setup(
             "dh_ctest_build=dhcmake.ctest:build",
             "dh_ctest_test=dhcmake.ctest:test",
             "dh_ctest_submit=dhcmake.ctest:submit",
+            "dh_ctest_steps=dhcmake.ctest:steps",
             "dh_cpack_generate=dhcmake.cpack:generate",
             "dh_cpack_substvars=dhcmake.cpack:substvars",
             "dh_cpack_install=dhcmake.cpack:install",
+            "dh_cmake_multi=dhcmake.multi:multi",
         ],
     },
     package_data={